@@ -0,0 +1,74 @@
+'''
+Check the import time of pyDIAUtils modules against a budget.
+
+Each import is timed in a fresh interpreter. Exits with a non-zero status
+if the median import time of any module is over its budget, or if importing
+a module loads a heavy dependency it should not.
+
+Usage: python benchmarks/import_time.py [--repeat N] [--scale X]
+'''
+
+import sys
+import os
+import argparse
+import subprocess
+import json
+from statistics import median
+
+# Budgets in milliseconds, and modules which must not be loaded by the import.
+BUDGETS = {
+    'pyDIAUtils': (50, ('pandas', 'matplotlib', 'sklearn')),
+    'pyDIAUtils.metadata': (50, ('pandas', 'matplotlib', 'sklearn')),
+    'pyDIAUtils.dia_db_utils': (1000, ('matplotlib', 'sklearn')),
+    'pyDIAUtils.histogram': (1000, ('matplotlib', 'sklearn')),
+    'pyDIAUtils.bar_chart': (1000, ('matplotlib', 'sklearn')),
+    'pyDIAUtils.pca_plot': (1000, ('matplotlib', 'sklearn')),
+    'pyDIAUtils.std_peptide_rt_plot': (1000, ('matplotlib', 'sklearn')),
+    'pyDIAUtils.parquet_io': (1000, ('matplotlib', 'sklearn')),
+    'pyDIAUtils.protein_rollup': (1000, ('matplotlib', 'sklearn')),
+    'pyDIAUtils.normalization': (1000, ('matplotlib', 'sklearn')),
+    'pyDIAUtils.report': (1000, ('matplotlib', 'sklearn')),
+    'pyDIAUtils.profiling': (50, ('pandas', 'matplotlib', 'sklearn')),
+}
+
+TIMER = '''
+import sys, time, json
+start = time.perf_counter()
+import {module}
+elapsed = (time.perf_counter() - start) * 1000
+print(json.dumps({{'ms': elapsed, 'modules': sorted({{m.split('.')[0] for m in sys.modules}})}}))
+'''
+
+
+def time_import(module):
+    result = subprocess.run([sys.executable, '-c', TIMER.format(module=module)],
+                            capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    return json.loads(result.stdout)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check pyDIAUtils import times.')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of times to time each import.')
+    parser.add_argument('--scale', type=float, default=1.0, help='Multiply all budgets by scale.')
+    args = parser.parse_args()
+
+    failed = False
+    for module, (budget, forbidden) in BUDGETS.items():
+        results = [time_import(module) for _ in range(args.repeat)]
+        ms = median(r['ms'] for r in results)
+        loaded = [m for m in forbidden if m in results[0]['modules']]
+
+        status = 'ok'
+        if ms > budget * args.scale:
+            status = 'OVER BUDGET'
+        if loaded:
+            status = f"loaded {', '.join(loaded)}"
+        failed = failed or status != 'ok'
+        print(f'{module:35} {ms:8.1f} ms (budget {budget * args.scale:.0f} ms) {status}')
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
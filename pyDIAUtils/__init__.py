@@ -1,9 +1,23 @@
 
-from . import bar_chart
-from . import histogram
-from . import pca_plot
-from . import std_peptide_rt_plot
+import importlib
+
+# logger configures logging when it is imported, so it is not loaded lazily.
 from . import logger
-from . import dia_db_utils
-from . import metadata
 
+# Submodules are imported the first time they are accessed so scripts
+# which only need dia_db_utils or metadata do not import matplotlib or sklearn.
+__all__ = ['bar_chart', 'histogram', 'pca_plot', 'std_peptide_rt_plot',
+           'logger', 'dia_db_utils', 'metadata', 'plotting', 'parquet_io',
+           'protein_rollup', 'normalization', 'report', 'profiling']
+
+
+def __getattr__(name):
+    if name in __all__:
+        module = importlib.import_module(f'.{name}', __name__)
+        globals()[name] = module
+        return module
+    raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -1,28 +1,73 @@
 
 import sqlite3
 import pandas as pd
-import matplotlib.pyplot as plt
 import numpy as np
 import re
 
+from .plotting import get_pyplot
+from .profiling import instrument_module
 
-def bar_chart(dat, ylab, xlab='Acquisition number', legend_title=None, fname=None, dpi=250):
+
+def group_rows(values, labels, max_groups):
+    '''
+    Average consecutive rows of values into at most max_groups groups.
+
+    Parameters
+    ----------
+    values: np.ndarray
+        Matrix with a row for each acquisition.
+    labels: np.ndarray
+        Numeric x position of each row.
+    max_groups: int
+        Maximum number of groups.
+
+    Returns
+    -------
+    values: np.ndarray
+        Mean of values in each group.
+    labels: np.ndarray
+        Mean x position of each group.
+    width: int
+        Number of rows in each group.
+    '''
+    n_rows = len(values)
+    width = max(1, -(-n_rows // max_groups))
+    if width == 1:
+        return values, labels, width
+
+    starts = np.arange(0, n_rows, width)
+    counts = np.diff(np.append(starts, n_rows))
+    values = np.add.reduceat(values, starts, axis=0) / counts[:, None]
+    labels = np.add.reduceat(labels.astype(np.float64), starts) / counts
+    return values, labels, width
+
+
+def bar_chart(dat, ylab, xlab='Acquisition number', legend_title=None, fname=None, dpi=250,
+              max_bars=None):
 
     '''
     Make bar chart from aggregated bar chart.
+
+    If max_bars is set, consecutive rows of dat are averaged into at most max_bars bars
+    drawn at the mean row position of each group.
     '''
+    plt = get_pyplot()
 
-    data = {c: dat[c].to_numpy() for c in dat.columns}
+    values = dat.to_numpy(dtype=np.float64)
     labels = dat.index.to_numpy()
-    
+    width = 1
+    if max_bars is not None:
+        values, labels, width = group_rows(values, np.arange(len(labels)), max_bars)
+
     fig = plt.figure(figsize = (6, 3), dpi=dpi)
     
     ax = fig.add_axes([0.1, 0.15, 0.86, 0.65])
     
-    bottom = np.zeros(len(dat))
-    for n_missed, counts in data.items():
-        ax.bar(labels, counts, 0.5, label = n_missed, bottom = bottom)
-        bottom += counts
+    # bottom of each stack level
+    bottoms = np.zeros_like(values)
+    bottoms[:, 1:] = np.cumsum(values, axis=1)[:, :-1]
+    for i, n_missed in enumerate(dat.columns):
+        ax.bar(labels, values[:, i], 0.5 * width, label = n_missed, bottom = bottoms[:, i])
     
     ax.set_xlabel(xlab)
     ax.set_ylabel(ylab)
@@ -42,3 +87,5 @@ def bar_chart(dat, ylab, xlab='Acquisition number', legend_title=None, fname=Non
         plt.show()
     plt.close()
 
+
+instrument_module(__name__)
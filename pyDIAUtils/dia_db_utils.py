@@ -1,19 +1,48 @@
 
 import sqlite3
+import os
 import re
-from datetime import datetime
-from collections import Counter
-
+import threading
+import hashlib
+import functools
+from copy import deepcopy
+from urllib.parse import quote
+from time import perf_counter
+from itertools import islice, chain
+from contextlib import contextmanager
+from collections import Counter, OrderedDict
+
+import numpy as np
 import pandas as pd
 
 from .metadata import Dtype
 from .logger import LOGGER
+from .profiling import instrument_module
 
 METADATA_TIME_FORMAT = '%m/%d/%Y %H:%M:%S'
 
 PRECURSOR_KEY_COLS = ('replicateId', 'modifiedSequence', 'precursorCharge')
 
-SCHEMA_VERSION = '1.12'
+PRECURSOR_COLS = PRECURSOR_KEY_COLS + ('precursorMz', 'averageMassErrorPPM',
+                                       'totalAreaFragment', 'totalAreaMs1', 'normalizedArea',
+                                       'rt', 'minStartTime', 'maxEndTime', 'maxFwhm',
+                                       'libraryDotProduct', 'isotopeDotProduct')
+
+# PRAGMA values applied while bulk loading. cache_size is in KiB when negative.
+BULK_LOAD_PRAGMAS = {'journal_mode': 'WAL',
+                     'synchronous': 'OFF',
+                     'cache_size': -262144}
+
+# PRAGMA values applied to read only connections.
+# 0x7fff0000 is the default maximum mmap_size SQLite is compiled with.
+READ_ONLY_PRAGMAS = {'mmap_size': 0x7fff0000,
+                     'cache_size': -262144,
+                     'temp_store': 'MEMORY'}
+
+# Maximum number of results kept in the in memory query cache.
+QUERY_CACHE_SIZE = 32
+
+SCHEMA_VERSION = '1.13'
 
 SCHEMA = ['PRAGMA foreign_keys = ON',
 '''
@@ -92,7 +121,381 @@ CREATE TABLE peptideToProtein (
     FOREIGN KEY (proteinId) REFERENCES proteins(proteinId) ON DELETE CASCADE
 )''']
 
+# Secondary indices. Added in schema version 1.13
+INDICES = [
+'CREATE INDEX IF NOT EXISTS idx_precursors_modifiedSequence ON precursors (modifiedSequence)',
+'CREATE INDEX IF NOT EXISTS idx_peptideToProtein_proteinId ON peptideToProtein (proteinId, modifiedSequence)',
+'CREATE INDEX IF NOT EXISTS idx_replicates_includeRep ON replicates (includeRep, acquiredRank)',
+'CREATE INDEX IF NOT EXISTS idx_replicates_acquiredRank ON replicates (acquiredRank)',
+'CREATE INDEX IF NOT EXISTS idx_proteinQuants_proteinId ON proteinQuants (proteinId)']
+
+SCHEMA += INDICES
+
+# Precursor RTs for the proteins in a list of protein names.
+# The {} is replaced with a placeholder for each protein.
+PRECURSOR_RT_QUERY = '''
+    SELECT
+        prot.name AS protein,
+        r.acquiredRank,
+        p.modifiedSequence,
+        p.precursorCharge,
+        p.rt,
+        p.minStartTime,
+        p.maxEndTime
+    FROM precursors p
+    JOIN replicates r
+        ON p.replicateId = r.replicateId
+    JOIN peptideToProtein ptp
+        ON p.modifiedSequence == ptp.modifiedSequence
+    JOIN proteins prot
+        ON prot.proteinId == ptp.proteinId
+    WHERE prot.name IN ({}) AND r.includeRep == TRUE;
+    '''
+
+# Queries used to generate reports. Used by explain_query_plans to check index coverage.
+REPORT_QUERIES = {
+'replicates': '''
+    SELECT replicateId, replicate, project, acquiredRank
+    FROM replicates
+    WHERE includeRep == TRUE
+    ORDER BY acquiredRank''',
+'protein_precursors': PRECURSOR_RT_QUERY.format('?'),
+'protein_list_precursors': PRECURSOR_RT_QUERY.format('?, ?'),
+'protein_peptides': '''
+    SELECT ptp.modifiedSequence
+    FROM peptideToProtein ptp
+    WHERE ptp.proteinId = ?''',
+'peptide_precursors': '''
+    SELECT replicateId, precursorCharge, totalAreaFragment, normalizedArea
+    FROM precursors
+    WHERE modifiedSequence = ?''',
+'protein_quants': '''
+    SELECT q.replicateId, q.abundance, q.normalizedAbundance
+    FROM proteinQuants q
+    LEFT JOIN proteins prot
+        ON prot.proteinId == q.proteinId
+    WHERE prot.name = ?'''}
+
+
+def connect_read_only(fname, immutable=False, pragmas=None):
+    '''
+    Open a read only database connection tuned for report generation.
+
+    Parameters
+    ----------
+    fname: str
+        Path to database file.
+    immutable: bool
+        Open the database with immutable=1 so SQLite skips all locking and
+        change detection. Only safe if nothing writes to the database while
+        it is open. Ignored if the database has a non-empty write ahead log,
+        because immutable connections do not read the log.
+    pragmas: dict
+        (optional) PRAGMA values to use in addition to READ_ONLY_PRAGMAS.
+
+    Returns
+    -------
+    conn: sqlite3.Connection
+    '''
+    path = os.path.abspath(fname)
+    wal_path = f'{path}-wal'
+    if immutable and os.path.isfile(wal_path) and os.path.getsize(wal_path) > 0:
+        LOGGER.warning(f"'{fname}' has uncommitted write ahead log. Not opening as immutable.")
+        immutable = False
+
+    uri = f"file:{quote(path)}?mode=ro{'&immutable=1' if immutable else ''}"
+    conn = sqlite3.connect(uri, uri=True)
+
+    cur = conn.cursor()
+    for pragma, value in {**READ_ONLY_PRAGMAS, **(pragmas or dict())}.items():
+        cur.execute(f'PRAGMA {pragma} = {value};')
+
+    return conn
+
+
+_READ_POOL = threading.local()
+
+
+def _read_pool():
+    ''' Get the read only connection pool for the current thread. '''
+    # Connections inherited from a parent process by fork can not be used.
+    if getattr(_READ_POOL, 'pid', None) != os.getpid():
+        _READ_POOL.pid = os.getpid()
+        _READ_POOL.connections = dict()
+    return _READ_POOL.connections
+
+
+@contextmanager
+def read_connection(fname, immutable=False):
+    '''
+    Context manager for a pooled read only database connection.
+
+    Each thread keeps one open connection per database so repeated reads reuse
+    a connection with a warm page cache instead of reopening the file.
+    The connection is not closed on exit. Use close_read_connections to close
+    the connections opened by the current thread.
+
+    Parameters
+    ----------
+    fname: str
+        Path to database file.
+    immutable: bool
+        See connect_read_only.
+
+    Yields
+    ------
+    conn: sqlite3.Connection
+    '''
+    pool = _read_pool()
+    key = (os.path.abspath(fname), immutable)
+    if key not in pool:
+        pool[key] = connect_read_only(fname, immutable=immutable)
+    yield pool[key]
+
+
+def close_read_connections():
+    ''' Close the pooled read only connections opened by the current thread. '''
+    pool = _read_pool()
+    for conn in pool.values():
+        conn.close()
+    pool.clear()
+
+
+_QUERY_CACHE = OrderedDict()
+_QUERY_CACHE_LOCK = threading.Lock()
+
+# Number of writes made through this module to each database in this process.
+_CACHE_VERSIONS = Counter()
+
+
+def _database_name(conn):
+    ''' Get the file path of the main database, or a unique name for an in memory database. '''
+    for _, name, path in conn.execute('PRAGMA database_list;'):
+        if name == 'main':
+            return path if path else f':memory:{id(conn)}'
+    return f':memory:{id(conn)}'
+
+
+def bump_cache_version(cur):
+    '''
+    Increment the in process cache version of the database cur is connected to
+    so cached query results for the database are no longer used.
+    Functions which write to the database should call this before committing.
+
+    Parameters
+    ----------
+    cur: sqlite3.Cursor
+        Cursor of the connection used for the write.
+    '''
+    database = _database_name(cur.connection)
+    with _QUERY_CACHE_LOCK:
+        _CACHE_VERSIONS[database] += 1
+
+
+def _file_signature(database):
+    '''
+    Get the modification time and size of a database file and its write ahead log.
+    These change when any connection or process commits to the database.
+    '''
+    signature = list()
+    for path in (database, f'{database}-wal'):
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            signature.append((stat.st_mtime_ns, stat.st_size))
+    return tuple(signature)
+
+
+def database_version(conn):
+    '''
+    Get a token which changes whenever the database content changes.
+
+    The token combines:
+    the number of writes made to the database through this module in this process,
+    PRAGMA data_version, which changes when another connection commits,
+    and the modification time and size of the database file and write ahead log,
+    which change when any connection commits. For in memory databases, which
+    are only visible to conn, Connection.total_changes is used instead.
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection:
+        Database connection.
+
+    Returns
+    -------
+    version: tuple
+        A (database, version) tuple.
+    '''
+    database = _database_name(conn)
+    data_version = conn.execute('PRAGMA data_version;').fetchone()[0]
+    if database.startswith(':memory:'):
+        signature = conn.total_changes
+    else:
+        signature = _file_signature(database)
+    with _QUERY_CACHE_LOCK:
+        cache_version = _CACHE_VERSIONS[database]
+    return database, (cache_version, data_version, signature)
+
+
+def clear_query_cache(conn=None):
+    '''
+    Clear the in memory query cache.
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection:
+        (optional) Only clear the results for the database conn is connected to.
+        If None, the whole cache is cleared.
+    '''
+    with _QUERY_CACHE_LOCK:
+        if conn is None:
+            _QUERY_CACHE.clear()
+        else:
+            database = _database_name(conn)
+            for key in [key for key in _QUERY_CACHE if key[0] == database]:
+                del _QUERY_CACHE[key]
+
+
+def _cache_get(key):
+    with _QUERY_CACHE_LOCK:
+        if key in _QUERY_CACHE:
+            _QUERY_CACHE.move_to_end(key)
+            return True, _QUERY_CACHE[key]
+    return False, None
+
+
+def _cache_put(key, value):
+    with _QUERY_CACHE_LOCK:
+        _QUERY_CACHE[key] = value
+        _QUERY_CACHE.move_to_end(key)
+        while len(_QUERY_CACHE) > QUERY_CACHE_SIZE:
+            _QUERY_CACHE.popitem(last=False)
+
+
+def _disk_cache_path(cache_dir, database, query, params):
+    '''
+    Get the Parquet file path for a cached query result.
+
+    Only the modification time and size of the database file and write ahead log
+    are part of the file name, because the other parts of the database version
+    are not meaningful in other processes.
+    '''
+    digest = hashlib.sha1(repr((query, params, _file_signature(database))).encode()).hexdigest()
+    return os.path.join(cache_dir, f'{digest}.parquet')
+
+
+def _have_parquet():
+    try:
+        import pyarrow
+    except ImportError:
+        return False
+    return True
+
+
+def cached_query(conn, query, params=None, cache_dir=None):
+    '''
+    Run a query with pd.read_sql, reusing the result if the same query
+    was already run on the same version of the database.
+    Results are not cached if conn has an open transaction.
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection:
+        Database connection.
+    query: str
+        The query.
+    params: tuple
+        (optional) Query parameters.
+    cache_dir: str
+        (optional) Directory to also cache results in as Parquet files, so they
+        can be reused by other processes. Requires pyarrow.
+
+    Returns
+    -------
+    df: pd.DataFrame
+        A copy of the cached result.
+    '''
+    params = tuple(params) if params is not None else tuple()
+
+    # Uncommitted changes are only visible to conn, so the result can not be shared.
+    if conn.in_transaction:
+        return pd.read_sql(query, conn, params=params)
+
+    database, version = database_version(conn)
+    key = (database, version, query, params)
+
+    found, df = _cache_get(key)
+    if found:
+        return df.copy()
+
+    fname = None
+    if cache_dir is not None and not database.startswith(':memory:'):
+        if _have_parquet():
+            fname = _disk_cache_path(cache_dir, database, query, params)
+        else:
+            LOGGER.warning('pyarrow is not installed. Query results will not be cached on disk.')
 
+    if fname is not None and os.path.isfile(fname):
+        df = pd.read_parquet(fname)
+    else:
+        df = pd.read_sql(query, conn, params=params)
+        if fname is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            df.to_parquet(fname, index=False)
+
+    _cache_put(key, df)
+    return df.copy()
+
+
+def _set_read_only(value):
+    ''' Make the numpy arrays in value, or in a tuple or list value, read only. '''
+    if isinstance(value, np.ndarray):
+        value.setflags(write=False)
+    elif isinstance(value, (tuple, list)):
+        for x in value:
+            _set_read_only(x)
+
+
+def memoize_query(fxn=None, copy=True):
+    '''
+    Decorator to cache the return value of a function which reads from the database.
+
+    The first argument of the decorated function must be the database connection.
+    The remaining arguments must be hashable. Values are not cached if conn has an
+    open transaction.
+
+    Parameters
+    ----------
+    copy: bool
+        If True, cached values are deep copied before they are returned so the
+        caller can modify them. If False, numpy arrays in the cached value are
+        made read only and the value is returned without copying. Use False for
+        functions returning large arrays.
+    '''
+    if fxn is None:
+        return functools.partial(memoize_query, copy=copy)
+
+    @functools.wraps(fxn)
+    def wrapper(conn, *args, **kwargs):
+        if conn.in_transaction:
+            return fxn(conn, *args, **kwargs)
+        database, version = database_version(conn)
+        key = (database, version, f'{fxn.__module__}.{fxn.__qualname__}',
+               args, tuple(sorted(kwargs.items())))
+        try:
+            found, value = _cache_get(key)
+        except TypeError:
+            return fxn(conn, *args, **kwargs)
+        if not found:
+            value = fxn(conn, *args, **kwargs)
+            if not copy:
+                _set_read_only(value)
+            _cache_put(key, value)
+        return deepcopy(value) if copy else value
+    return wrapper
+
+
+@memoize_query
 def is_normalized(conn):
     ''' Determine if metadata.is_normalized is True '''
 
@@ -124,13 +527,7 @@ def insert_program_metadata_key_pairs(conn, metadata):
     metadata: dict
         A dict with key, value pairs.
     '''
-    cur = conn.cursor()
-    for key, value in metadata.items():
-        cur.execute(f'''
-            INSERT INTO metadata
-                (key, value) VALUES ("{key}", "{value}")
-            ON CONFLICT(key) DO UPDATE SET value = "{value}" ''')
-    conn.commit()
+    upsert_metadata(conn, metadata)
     return conn
 
 
@@ -145,11 +542,191 @@ def get_meta_value(conn, key):
     return None
 
 
+def create_indices(conn):
+    '''
+    Create any of the secondary indices in INDICES which do not already exist.
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection:
+        Database connection.
+    '''
+    cur = conn.cursor()
+    for index in INDICES:
+        cur.execute(index)
+    conn.commit()
+    return conn
+
+
+def explain_query_plans(conn, queries=None):
+    '''
+    Run EXPLAIN QUERY PLAN on queries and find the steps which scan an entire table.
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection:
+        Database connection.
+    queries: dict
+        A dict mapping query names to SQL. Placeholders are bound to NULL.
+        The default is REPORT_QUERIES.
+
+    Returns
+    -------
+    scans: dict
+        A dict mapping query names to a list of query plan details for each
+        full table scan. Queries without scans map to an empty list.
+    '''
+    queries = REPORT_QUERIES if queries is None else queries
+
+    cur = conn.cursor()
+    scans = dict()
+    for name, query in queries.items():
+        n_params = query.count('?')
+        cur.execute(f'EXPLAIN QUERY PLAN {query}', (None,) * n_params)
+
+        # Index lookups are 'SEARCH ...' steps. 'SCAN ...' steps read every row
+        # of a table or index, including 'SCAN p USING COVERING INDEX ...'
+        scans[name] = [row[3] for row in cur.fetchall() if row[3].startswith('SCAN ')]
+        for detail in scans[name]:
+            LOGGER.warning(f"Full table scan in query '{name}': {detail}")
+
+    return scans
+
+
 def check_schema_version(conn):
     db_version = get_meta_value(conn, 'schema_version')
     if db_version is None or db_version != SCHEMA_VERSION:
         LOGGER.error(f'Database schema version ({db_version}) does not match program ({SCHEMA_VERSION})')
+        if migration_path(db_version) is not None:
+            LOGGER.error('The database can be upgraded in place with upgrade_schema.')
+        return False
+    return True
+
+
+# Registry of schema migrations. Maps the version being upgraded from to a
+# tuple of the version being upgraded to and the function performing the upgrade.
+MIGRATIONS = dict()
+
+
+def _migration(from_version, to_version):
+    '''
+    Register a function to upgrade the database schema from from_version to to_version.
+
+    The function is called with a sqlite3.Connection inside an open transaction.
+    It should not commit. The schema_version metadata key is updated by upgrade_schema.
+    '''
+    def decorator(fxn):
+        MIGRATIONS[from_version] = (to_version, fxn)
+        return fxn
+    return decorator
+
+
+def _table_indices(cur, table):
+    ''' Get a list of (name, sql) tuples for the indices created with CREATE INDEX on table. '''
+    cur.execute('''
+        SELECT name, sql FROM sqlite_master
+        WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL; ''', (table,))
+    return cur.fetchall()
+
+
+@_migration('1.12', '1.13')
+def _add_secondary_indices(conn):
+    ''' Add secondary indices '''
+    cur = conn.cursor()
+    for index in INDICES:
+        cur.execute(index)
+
+
+def migration_path(db_version, to_version=SCHEMA_VERSION):
+    '''
+    Get the ordered list of migrations needed to upgrade the database schema.
+
+    Parameters
+    ----------
+    db_version: str
+        The current database schema version.
+    to_version: str
+        The target schema version. The default is SCHEMA_VERSION.
+
+    Returns
+    -------
+    path: list
+        A list of (from_version, to_version, function) tuples.
+        None if there is no path between the versions.
+    '''
+    path = list()
+    version = db_version
+    while version != to_version:
+        if version not in MIGRATIONS:
+            return None
+        next_version, fxn = MIGRATIONS[version]
+        path.append((version, next_version, fxn))
+        version = next_version
+    return path
+
+
+def upgrade_schema(conn, dry_run=False):
+    '''
+    Upgrade the database schema in place to SCHEMA_VERSION.
+
+    Each migration step is run in its own transaction with foreign key
+    enforcement off. If a step fails it is rolled back and the database
+    is left at the last successfully upgraded version. Exceptions other
+    than sqlite3.Error are raised after the step is rolled back.
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection:
+        Database connection.
+    dry_run: bool
+        Only log the migration steps which would be run without changing the database.
+
+    Returns
+    -------
+    success: bool
+    '''
+    db_version = get_meta_value(conn, 'schema_version')
+    path = migration_path(db_version)
+    if path is None:
+        LOGGER.error(f'No migration path from schema version {db_version} to {SCHEMA_VERSION}!')
         return False
+    if len(path) == 0:
+        LOGGER.info(f'Database schema is already version {SCHEMA_VERSION}.')
+        return True
+
+    for from_version, to_version, fxn in path:
+        LOGGER.info(f'{"Would upgrade" if dry_run else "Upgrading"} schema {from_version} -> {to_version}: '
+                    f'{(fxn.__doc__ or fxn.__name__).strip()}')
+    if dry_run:
+        return True
+
+    conn.commit()
+    cur = conn.cursor()
+    foreign_keys = cur.execute('PRAGMA foreign_keys;').fetchone()[0]
+    cur.execute('PRAGMA foreign_keys = OFF;')
+    try:
+        for from_version, to_version, fxn in path:
+            cur.execute('BEGIN;')
+            try:
+                fxn(conn)
+                violations = cur.execute('PRAGMA foreign_key_check;').fetchall()
+                if len(violations) > 0:
+                    raise sqlite3.IntegrityError(f'{len(violations)} foreign key violations')
+                cur.execute("UPDATE metadata SET value = ? WHERE key == 'schema_version';", (to_version,))
+                bump_cache_version(cur)
+            except sqlite3.Error as e:
+                conn.rollback()
+                LOGGER.error(f'Failed to upgrade schema {from_version} -> {to_version}: {e}')
+                return False
+            except BaseException:
+                # Leave no transaction open so foreign_keys can be restored below.
+                conn.rollback()
+                raise
+            conn.commit()
+            LOGGER.info(f'Database schema upgraded to {to_version}.')
+    finally:
+        cur.execute(f'PRAGMA foreign_keys = {foreign_keys};')
+
     return True
 
 
@@ -172,32 +749,57 @@ def update_meta_value(conn, key, value):
             (key, value) VALUES (?, ?)
         ON CONFLICT(key) DO UPDATE SET value = ? ''',
                 (key, value, value))
+    bump_cache_version(cur)
     conn.commit()
 
     return conn
 
 
+def _acquired_rank_updates(conn):
+    '''
+    Get (acquiredRank, replicateId) tuples for the replicates with an
+    acquiredRank which is out of date.
+
+    Included replicates are ranked by acquiredTime starting at 0, followed by
+    the excluded replicates, so every replicate has a unique rank.
+    '''
+    replicates = pd.read_sql('''
+        SELECT replicateId, includeRep, acquiredTime, acquiredRank
+        FROM replicates
+        ORDER BY replicateId; ''', conn)
+
+    # parse acquired times and rank them. Ties are ranked in replicateId order
+    acquired_times = pd.to_datetime(replicates['acquiredTime'], format=METADATA_TIME_FORMAT)
+    order = np.lexsort((acquired_times.to_numpy().astype(np.int64),
+                        ~replicates['includeRep'].to_numpy(dtype=bool)))
+    new_ranks = np.empty(len(order), dtype=np.int64)
+    new_ranks[order] = np.arange(len(order))
+
+    # only update ranks which changed
+    changed = new_ranks != replicates['acquiredRank'].to_numpy()
+    return list(zip(new_ranks[changed].tolist(),
+                    replicates.loc[changed, 'replicateId'].tolist()))
+
+
 def update_acquired_ranks(conn):
     '''
     Populate acquiredRank column in replicates table.
 
+    Included replicates are ranked by acquiredTime starting at 0. Excluded
+    replicates are ranked after all the included replicates.
+
     Parameters
     ----------
     conn: sqlite3.Connection:
         Database connection.
     '''
-
-    replicates = pd.read_sql('SELECT replicateId, acquiredTime FROM replicates WHERE includeRep == TRUE;', conn)
-
-    # parse acquired times and add acquiredRank
-    replicates['acquiredTime'] = replicates['acquiredTime'].apply(lambda x: datetime.strptime(x, METADATA_TIME_FORMAT))
-    ranks = list(enumerate(replicates['acquiredTime'].sort_values().index))
-    replicates['acquiredRank'] = [x[0] for x in sorted(ranks, key=lambda x: x[1])]
-
-    acquired_ranks = [(row.acquiredRank, row.replicateId) for row in replicates.itertuples()]
-    cur = conn.cursor()
-    cur.executemany('UPDATE replicates SET acquiredRank = ? WHERE replicateId = ?', acquired_ranks)
-    conn.commit()
+    acquired_ranks = _acquired_rank_updates(conn)
+    if len(acquired_ranks) > 0:
+        cur = conn.cursor()
+        cur.executemany('UPDATE replicates SET acquiredRank = ? WHERE replicateId = ?', acquired_ranks)
+        bump_cache_version(cur)
+        conn.commit()
+    LOGGER.debug(f'Updated {len(acquired_ranks)} acquiredRank values.')
 
     return update_meta_value(conn, 'replicates.acquiredRank updated', True)
 
@@ -230,82 +832,297 @@ def update_metadata_dtypes(conn, new_types):
         existing_types[key] = max(existing_types[key], value)
 
     # Update database
-    insert_query = '''
-        INSERT INTO sampleMetadataTypes (annotationKey, annotationType)
-        VALUES(?, ?)
-        ON CONFLICT(annotationKey) DO UPDATE SET annotationType = ?
+    upsert_sample_metadata_types(conn, {key: existing_types[key] for key in new_types})
+
+    return conn
+
+
+def bulk_upsert(conn, table, key_cols, value_cols, rows):
+    '''
+    Insert or update rows in table in a single transaction.
+
+    Rows are first written to a temporary table with executemany so the
+    number of existing keys can be counted before they are overwritten.
+    If rows has duplicate keys, the last row is used. If conn already has an
+    open transaction the rows are written in it, and it is committed.
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection:
+        Database connection.
+    table: str
+        Name of table.
+    key_cols: tuple
+        Columns of the primary key of table.
+    value_cols: tuple
+        Columns to insert or update.
+    rows: iterable
+        Tuples with the values of key_cols followed by value_cols.
+
+    Returns
+    -------
+    counts: dict
+        A dict with the number of rows 'inserted' and 'updated'.
+        None if the transaction failed.
     '''
+    cols = key_cols + value_cols
+    tmp_table = f'{table}Upsert'
+
     cur = conn.cursor()
-    for annotationKey, dtype in existing_types.items():
-        annotationType = str(dtype)
-        cur.execute(insert_query, (annotationKey, annotationType, annotationType))
+    try:
+        if not conn.in_transaction:
+            cur.execute('BEGIN;')
+        cur.execute(f'DROP TABLE IF EXISTS temp.{tmp_table};')
+        cur.execute(f'''
+            CREATE TEMP TABLE {tmp_table} ({', '.join(cols)},
+                                           PRIMARY KEY ({', '.join(key_cols)})); ''')
+        cur.executemany(f'''
+            INSERT OR REPLACE INTO {tmp_table} ({', '.join(cols)})
+            VALUES ({', '.join(['?'] * len(cols))}) ''', rows)
+
+        n_rows = cur.execute(f'SELECT COUNT(*) FROM {tmp_table};').fetchone()[0]
+        n_updated = cur.execute(f'''
+            SELECT COUNT(*) FROM {tmp_table} t
+            JOIN {table} USING ({', '.join(key_cols)}); ''').fetchone()[0]
+
+        # 'WHERE true' is needed to parse an upsert from a SELECT
+        cur.execute(f'''
+            INSERT INTO {table} ({', '.join(cols)})
+            SELECT {', '.join(cols)} FROM {tmp_table} WHERE true
+            ON CONFLICT ({', '.join(key_cols)}) DO UPDATE SET
+                {', '.join(f'{col} = excluded.{col}' for col in value_cols)}; ''')
+        cur.execute(f'DROP TABLE temp.{tmp_table};')
+        bump_cache_version(cur)
+    except sqlite3.Error as e:
+        conn.rollback()
+        LOGGER.error(f'Failed to update {table} table: {e}')
+        return None
     conn.commit()
 
-    return conn
+    LOGGER.debug(f'Inserted {n_rows - n_updated} and updated {n_updated} rows in {table} table.')
+    return {'inserted': n_rows - n_updated, 'updated': n_updated}
 
 
-def mark_reps_skipped(conn, reps=None, projects=None):
+def upsert_metadata(conn, metadata):
     '''
-    Mark replicates and/or projects skipped.
+    Insert or update multiple key, value pairs in the metadata table
+    in a single transaction. Values are stored as strings.
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection:
+        Database connection.
+    metadata: dict
+        A dict with key, value pairs.
+
+    Returns
+    -------
+    counts: dict
+        A dict with the number of keys 'inserted' and 'updated'.
     '''
+    return bulk_upsert(conn, 'metadata', ('key',), ('value',),
+                        ((key, str(value)) for key, value in metadata.items()))
 
-    reps = reps if reps is not None else []
-    projects = projects if projects is not None else []
 
-    # retrieve data from replicates table
-    cur = conn.cursor()
-    cur.execute('SELECT replicateId, replicate, project, includeRep FROM replicates;')
-    db_reps = cur.fetchall()
+def upsert_sample_metadata_types(conn, types):
+    '''
+    Insert or update annotationTypes in the sampleMetadataTypes table
+    in a single transaction. Existing types are overwritten without
+    consolidation. Use update_metadata_dtypes to consolidate types.
 
-    db_rep_index = dict()
-    for i, rep in enumerate(db_reps):
-        if rep in db_rep_index:
-            db_rep_index[rep[1]][rep[2]] = i
-        else:
-            db_rep_index[rep[1]] = {rep[2]: i}
+    Parameters
+    ----------
+    conn: sqlite3.Connection:
+        Database connection.
+    types: dict
+        A dict mapping annotationKeys to Dtypes.
 
-    def check_missing(var_name, missing_vals):
-        if len(missing_vals) > 0:
-            for rep in reps:
-                LOGGER.error(f"{var_name} '{rep}' is not in database!")
-            return True
-        return False
+    Returns
+    -------
+    counts: dict
+        A dict with the number of annotationKeys 'inserted' and 'updated'.
+    '''
+    return bulk_upsert(conn, 'sampleMetadataTypes', ('annotationKey',), ('annotationType',),
+                        ((key, str(dtype)) for key, dtype in types.items()))
+
+
+def upsert_sample_metadata(conn, rows):
+    '''
+    Insert or update annotation values in the sampleMetadata table
+    in a single transaction. The annotationKeys must already be in
+    the sampleMetadataTypes table.
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection:
+        Database connection.
+    rows: pd.DataFrame or iterable of tuples
+        A DataFrame with the columns replicateId, annotationKey, and annotationValue,
+        or (replicateId, annotationKey, annotationValue) tuples.
+
+    Returns
+    -------
+    counts: dict
+        A dict with the number of rows 'inserted' and 'updated'.
+    '''
+    if isinstance(rows, pd.DataFrame):
+        rows = rows[['replicateId', 'annotationKey', 'annotationValue']].itertuples(index=False, name=None)
+    return bulk_upsert(conn, 'sampleMetadata', ('replicateId', 'annotationKey'), ('annotationValue',), rows)
+
+
+def _reset_normalized(cur):
+    '''
+    Set metadata.is_normalized to False if it is True. normalizedArea values are
+    only written for included replicates, so they are out of date when the
+    included replicates change. Call inside the write transaction.
+    '''
+    value = cur.execute("SELECT value FROM metadata WHERE key == 'is_normalized';").fetchone()
+    if value is not None and str(value[0]).lower() in ('true', '1'):
+        LOGGER.warning('Included replicates changed. Setting metadata.is_normalized to False.')
+        cur.execute("UPDATE metadata SET value = 'False' WHERE key == 'is_normalized';")
 
-    # make sure all reps and projects specified exist in db
-    missing_reps = [rep for rep in reps if rep not in db_rep_index]
-    all_projects = {x for xs in [list(rep.keys()) for rep in db_rep_index.values()] for x in xs}
-    missing_projects = [proj for proj in projects if proj not in all_projects]
-    if check_missing('Replicate', missing_reps) or check_missing('Project', missing_projects):
-        return False
 
-    rep_index_to_false = []
-    for rep in reps:
-        for i in db_rep_index[rep].values():
-            rep_index_to_false.append(i)
+def exclude_replicates(conn, reps=None, projects=None, patterns=None):
+    '''
+    Mark replicates and/or projects skipped and report what was excluded.
 
-    for rep, rep_projects in db_rep_index.items():
-        for proj in projects:
-            if proj in rep_projects:
-                rep_index_to_false.append(rep_projects[proj])
+    Names are written to temp tables and matching replicates are excluded with
+    a single UPDATE, in one transaction with the acquiredRank update.
+    If any name or pattern does not match a replicate, nothing is changed.
+    If any replicate is excluded, metadata.is_normalized is set to False.
 
-    rep_index_to_false = Counter(rep_index_to_false)
-    for rep_i, count in rep_index_to_false.items():
-        if count > 1:
-            LOGGER.warning(f"Replicate '{db_reps[rep_i][1]}' was set to be excluded {count} times!")
+    Parameters
+    ----------
+    conn: sqlite3.Connection:
+        Database connection.
+    reps: list
+        (optional) Names of replicates to exclude in all projects.
+    projects: list
+        (optional) Names of projects to exclude.
+    patterns: list
+        (optional) Glob patterns matched against replicate names with the
+        case sensitive SQLite GLOB operator.
+
+    Returns
+    -------
+    report: dict
+        A dict with the keys:
+        'success': True if the replicates were excluded, False if any name or
+        pattern does not match a replicate,
+        'excluded': number of included replicates which were excluded,
+        'missing_reps', 'missing_projects', 'missing_patterns': names and patterns
+        which did not match any replicate,
+        'duplicates': (replicate, project, count) tuples for replicates matched more than once,
+        'already_excluded': (replicate, project) tuples for matched replicates
+        which were already excluded.
+        None if the transaction failed.
+    '''
+    names = {'reps': reps, 'projects': projects, 'patterns': patterns}
+    names = {key: list(dict.fromkeys(values)) if values is not None else []
+             for key, values in names.items()}
 
-    LOGGER.info(f'Excluding {len(rep_index_to_false)} replicates.')
+    conn.commit()
     cur = conn.cursor()
-    cur.executemany('UPDATE replicates SET includeRep = FALSE WHERE replicateId = ?;',
-                    [(db_reps[rep_i][0],) for rep_i in rep_index_to_false])
+    try:
+        cur.execute('BEGIN;')
+        for key, values in names.items():
+            cur.execute(f'DROP TABLE IF EXISTS temp.skip_{key};')
+            cur.execute(f'CREATE TEMP TABLE skip_{key} (name TEXT PRIMARY KEY);')
+            cur.executemany(f'INSERT INTO temp.skip_{key} (name) VALUES (?);',
+                            [(value,) for value in values])
+
+        report = dict()
+        for key, column, test in (('reps', 'replicate', 'r.replicate = s.name'),
+                                  ('projects', 'project', 'r.project = s.name'),
+                                  ('patterns', 'replicate', 'r.replicate GLOB s.name')):
+            cur.execute(f'''
+                SELECT s.name FROM temp.skip_{key} s
+                WHERE NOT EXISTS (SELECT 1 FROM replicates r WHERE {test}); ''')
+            report[f'missing_{key}'] = [x[0] for x in cur.fetchall()]
+
+        # number of times each replicate is matched by a name or pattern
+        cur.execute('DROP TABLE IF EXISTS temp.skip_matches;')
+        cur.execute('''
+            CREATE TEMP TABLE skip_matches AS
+            SELECT replicate, project, includeRep, n_matches FROM (
+                SELECT r.replicate, r.project, r.includeRep,
+                    (r.replicate IN temp.skip_reps) +
+                    (r.project IN temp.skip_projects) +
+                    (SELECT COUNT(*) FROM temp.skip_patterns p WHERE r.replicate GLOB p.name) AS n_matches
+                FROM replicates r)
+            WHERE n_matches > 0; ''')
+        report['excluded'] = cur.execute('''
+            SELECT COUNT(*) FROM temp.skip_matches
+            WHERE includeRep == TRUE; ''').fetchone()[0]
+        report['duplicates'] = cur.execute('''
+            SELECT replicate, project, n_matches FROM temp.skip_matches
+            WHERE n_matches > 1; ''').fetchall()
+        report['already_excluded'] = cur.execute('''
+            SELECT replicate, project FROM temp.skip_matches
+            WHERE includeRep == FALSE; ''').fetchall()
+
+        missing = any(len(report[f'missing_{key}']) > 0 for key in names)
+        if not missing:
+            cur.execute('''
+                UPDATE replicates SET includeRep = FALSE
+                WHERE (replicate, project) IN (SELECT replicate, project FROM temp.skip_matches); ''')
+            cur.executemany('UPDATE replicates SET acquiredRank = ? WHERE replicateId = ?',
+                            _acquired_rank_updates(conn))
+            cur.execute('''
+                INSERT INTO metadata (key, value) VALUES ('replicates.acquiredRank updated', TRUE)
+                ON CONFLICT(key) DO UPDATE SET value = excluded.value; ''')
+            if report['excluded'] > 0:
+                _reset_normalized(cur)
+            bump_cache_version(cur)
+
+        for table in [f'skip_{key}' for key in names] + ['skip_matches']:
+            cur.execute(f'DROP TABLE temp.{table};')
+    except sqlite3.Error as e:
+        conn.rollback()
+        LOGGER.error(f'Failed to exclude replicates: {e}')
+        return None
+
+    if missing:
+        conn.rollback()
+        for key, name in (('reps', 'Replicate'), ('projects', 'Project')):
+            for value in report[f'missing_{key}']:
+                LOGGER.error(f"{name} '{value}' is not in database!")
+        for pattern in report['missing_patterns']:
+            LOGGER.error(f"Pattern '{pattern}' does not match any replicate!")
+        report['excluded'] = 0
+        report['success'] = False
+        return report
     conn.commit()
-    conn = update_acquired_ranks(conn)
 
-    return True
+    for rep, project, count in report['duplicates']:
+        LOGGER.warning(f"Replicate '{rep}' in project '{project}' was set to be excluded {count} times!")
+    if len(report['already_excluded']) > 0:
+        LOGGER.warning(f"{len(report['already_excluded'])} replicates were already excluded.")
+    LOGGER.info(f"Excluded {report['excluded']} replicates.")
+
+    report['success'] = True
+    return report
+
+
+def mark_reps_skipped(conn, reps=None, projects=None, patterns=None):
+    '''
+    Mark replicates and/or projects skipped.
+    See exclude_replicates for the parameters.
+
+    Returns
+    -------
+    success: bool
+        True if the replicates were excluded. False if any name or pattern
+        does not match a replicate or the transaction failed.
+    '''
+    report = exclude_replicates(conn, reps=reps, projects=projects, patterns=patterns)
+    return report is not None and report['success']
 
 
 def mark_all_reps_includced(conn):
     '''
     Set all replicates.includeRep values to TRUE and update replicates.acquiredRank if necissary.
+    If any replicate is included, metadata.is_normalized is set to False.
     '''
     cur = conn.cursor()
     cur.execute('SELECT includeRep, COUNT(includeRep) FROM replicates GROUP BY includeRep;')
@@ -314,12 +1131,628 @@ def mark_all_reps_includced(conn):
     if 0 in include_rep_counts:
         LOGGER.info(f'Setting {include_rep_counts[0]} includeRep values to TRUE.')
         cur.execute('UPDATE replicates SET includeRep = TRUE;')
+        _reset_normalized(cur)
+        bump_cache_version(cur)
         conn.commit()
         conn = update_acquired_ranks(conn)
     else:
         LOGGER.warning(f'All replicates are already included.')
 
 
+@memoize_query
+def get_replicate_ids(conn, project=None):
+    '''
+    Get a dict mapping replicate names to replicateIds.
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection:
+        Database connection.
+    project: str
+        (optional) Only include replicates in project.
+        If None, replicate names must be unique across all projects.
+
+    Returns
+    -------
+    rep_ids: dict
+        A dict mapping replicate names to replicateIds.
+        None if replicate names are not unique.
+    '''
+    cur = conn.cursor()
+    if project is None:
+        cur.execute('SELECT replicate, replicateId FROM replicates;')
+    else:
+        cur.execute('SELECT replicate, replicateId FROM replicates WHERE project = ?;', (project,))
+    rows = cur.fetchall()
+
+    rep_ids = dict(rows)
+    if len(rep_ids) != len(rows):
+        LOGGER.error('Replicate names are not unique across projects! A project must be specified.')
+        return None
+    return rep_ids
+
+
+@contextmanager
+def _bulk_write_mode(conn, table):
+    '''
+    Apply BULK_LOAD_PRAGMAS, disable foreign key enforcement, and drop the
+    secondary indices on table for the duration of the context.
+    Indices and original PRAGMA values are restored on exit.
+    '''
+    conn.commit()
+    cur = conn.cursor()
+
+    original = {pragma: cur.execute(f'PRAGMA {pragma};').fetchone()[0]
+                for pragma in list(BULK_LOAD_PRAGMAS) + ['foreign_keys']}
+    for pragma, value in BULK_LOAD_PRAGMAS.items():
+        cur.execute(f'PRAGMA {pragma} = {value};')
+    cur.execute('PRAGMA foreign_keys = OFF;')
+
+    indices = _table_indices(cur, table)
+    for name, _ in indices:
+        cur.execute(f'DROP INDEX {name};')
+    conn.commit()
+
+    try:
+        yield conn
+    finally:
+        conn.rollback()
+        for _, sql in indices:
+            cur.execute(sql)
+        conn.commit()
+        for pragma, value in original.items():
+            cur.execute(f'PRAGMA {pragma} = {value};')
+
+
+def _row_batches(data, columns, batch_size):
+    '''
+    Yield lists of row tuples with at most batch_size rows from data.
+    data can be a pd.DataFrame, an iterable of pd.DataFrames, or an iterable of tuples.
+    '''
+    if isinstance(data, pd.DataFrame):
+        data = (data,)
+
+    data = iter(data)
+    first = next(data, None)
+    if first is None:
+        return
+    data = chain((first,), data)
+
+    if isinstance(first, pd.DataFrame):
+        for df in data:
+            for start in range(0, len(df.index), batch_size):
+                chunk = df.iloc[start:start + batch_size]
+                yield list(chunk[list(columns)].itertuples(index=False, name=None))
+    else:
+        while batch := list(islice(data, batch_size)):
+            yield batch
+
+
+def insert_precursors(conn, data, project=None, columns=None,
+                      batch_size=100000, replace=False):
+    '''
+    Bulk load rows into the precursors table.
+
+    Rows are written with executemany in batches of batch_size in a single
+    transaction, so if any batch fails none of the rows are loaded. While
+    loading, BULK_LOAD_PRAGMAS are applied, secondary indices on precursors
+    are dropped and rebuilt at the end, and foreign key enforcement is
+    replaced by a replicateId lookup for each row.
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection:
+        Database connection.
+    data: pd.DataFrame, iterable of pd.DataFrame or iterable of tuples
+        The precursor rows. DataFrames must have the columns in `columns`.
+        Tuples must have their values in the same order as `columns`.
+    project: str
+        (optional) Project used to map replicate names to replicateIds.
+    columns: tuple
+        The column names in data. The first column must be either 'replicate'
+        (which is mapped to replicateId) or 'replicateId'. The default is
+        PRECURSOR_COLS with 'replicateId' replaced by 'replicate'.
+    batch_size: int
+        Number of rows per executemany call.
+    replace: bool
+        Replace existing rows with the same primary key? If False, a duplicate
+        key is an error.
+
+    Returns
+    -------
+    stats: dict
+        A dict with the keys 'rows', 'seconds' and 'rows_per_second'.
+        None if the load failed. In that case the whole load is rolled back.
+    '''
+    if columns is None:
+        columns = ('replicate',) + PRECURSOR_COLS[1:]
+    columns = tuple(columns)
+
+    if columns[0] not in ('replicate', 'replicateId'):
+        LOGGER.error("The first column must be 'replicate' or 'replicateId'!")
+        return None
+    unknown_cols = [col for col in columns[1:] if col not in PRECURSOR_COLS]
+    if len(unknown_cols) > 0:
+        LOGGER.error(f'Unknown precursor columns: {unknown_cols}')
+        return None
+
+    if columns[0] == 'replicate':
+        rep_ids = get_replicate_ids(conn, project=project)
+        if rep_ids is None:
+            return None
+    else:
+        cur = conn.cursor()
+        cur.execute('SELECT replicateId FROM replicates;')
+        rep_ids = {x[0]: x[0] for x in cur.fetchall()}
+
+    db_cols = ('replicateId',) + columns[1:]
+    query = f'''
+        INSERT {'OR REPLACE ' if replace else ''}INTO precursors ({', '.join(db_cols)})
+        VALUES ({', '.join(['?'] * len(db_cols))}) '''
+
+    n_rows = 0
+    start_time = perf_counter()
+    # _bulk_write_mode rolls back anything not committed on exit
+    with _bulk_write_mode(conn, 'precursors'):
+        cur = conn.cursor()
+        cur.execute('BEGIN;')
+        for batch in _row_batches(data, columns, batch_size):
+            try:
+                batch = [(rep_ids[row[0]],) + tuple(row[1:]) for row in batch]
+            except KeyError as e:
+                LOGGER.error(f'{columns[0]} {e} is not in database!')
+                return None
+
+            try:
+                cur.executemany(query, batch)
+            except sqlite3.Error as e:
+                LOGGER.error(f'Failed to insert precursors: {e}')
+                return None
+
+            n_rows += len(batch)
+            LOGGER.debug(f'Inserted {n_rows} precursor rows.')
+
+        bump_cache_version(cur)
+        conn.commit()
+
+    seconds = perf_counter() - start_time
+    rows_per_second = n_rows / seconds if seconds > 0 else float('inf')
+    LOGGER.info(f'Inserted {n_rows} precursor rows in {seconds:.1f} seconds ({rows_per_second:.0f} rows/s).')
+
+    return {'rows': n_rows, 'seconds': seconds, 'rows_per_second': rows_per_second}
+
+
+# Name the source database is attached as by merge_database.
+MERGE_SOURCE = 'mergeSource'
+
+
+def _merge_protein_ids(cur):
+    '''
+    Add the proteins in the source database which are not already in the main
+    database and populate temp.mergeProteinIds with (sourceId, proteinId) pairs.
+    Proteins are matched by name, or by accession if name is NULL. Proteins which
+    are not matched, including those without a name or accession, are added with
+    new proteinIds so every source protein is mapped.
+    '''
+    cur.execute('CREATE TEMP TABLE mergeProteinIds (sourceId INTEGER PRIMARY KEY, proteinId INTEGER NOT NULL);')
+    cur.execute(f'''
+        INSERT OR IGNORE INTO temp.mergeProteinIds (sourceId, proteinId)
+        SELECT s.proteinId, p.proteinId FROM {MERGE_SOURCE}.proteins s
+        JOIN main.proteins p ON p.name = s.name
+        UNION ALL
+        SELECT s.proteinId, p.proteinId FROM {MERGE_SOURCE}.proteins s
+        JOIN main.proteins p ON p.accession = s.accession
+        WHERE s.name IS NULL AND p.name IS NULL; ''')
+
+    # assign new proteinIds after the largest existing id
+    max_id = cur.execute('SELECT COALESCE(MAX(proteinId), 0) FROM main.proteins;').fetchone()[0]
+    cur.execute(f'''
+        INSERT INTO temp.mergeProteinIds (sourceId, proteinId)
+        SELECT s.proteinId, ? + ROW_NUMBER() OVER (ORDER BY s.proteinId)
+        FROM {MERGE_SOURCE}.proteins s
+        WHERE s.proteinId NOT IN (SELECT sourceId FROM temp.mergeProteinIds); ''', (max_id,))
+    cur.execute(f'''
+        INSERT INTO main.proteins (proteinId, accession, name, description)
+        SELECT m.proteinId, s.accession, s.name, s.description
+        FROM {MERGE_SOURCE}.proteins s
+        JOIN temp.mergeProteinIds m ON m.sourceId = s.proteinId
+        WHERE m.proteinId > ?
+        ORDER BY m.proteinId; ''', (max_id,))
+    return cur.rowcount
+
+
+def merge_database(conn, source):
+    '''
+    Add the replicates, precursors, proteins, proteinQuants and sample
+    metadata in another database to an existing database.
+
+    The source database is attached and rows are copied inside SQLite in a
+    single transaction, so either the whole source database is merged or
+    nothing is. replicateIds and proteinIds are remapped. Proteins are matched
+    by name, or by accession if name is NULL, and peptideToProtein is upserted.
+    Source proteins without a match are added as new proteins. Conflicting annotationTypes are
+    consolidated the same way as update_metadata_dtypes. acquiredRank is
+    recomputed once at the end. Since normalized values from different
+    databases are not comparable, is_normalized is set to False.
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection:
+        Database connection.
+    source: str
+        Path to the database to merge. It must have the same schema version
+        and none of its (replicate, project) pairs can already be in conn.
+
+    Returns
+    -------
+    counts: dict
+        A dict mapping table names to the number of rows added.
+        None if the merge failed.
+    '''
+    if not check_schema_version(conn):
+        return None
+    if not os.path.isfile(source):
+        LOGGER.error(f"Database '{source}' does not exist!")
+        return None
+
+    conn.commit()
+    cur = conn.cursor()
+    cur.execute(f'ATTACH DATABASE ? AS {MERGE_SOURCE};', (source,))
+    try:
+        source_version = cur.execute(f'''
+            SELECT value FROM {MERGE_SOURCE}.metadata
+            WHERE key == 'schema_version'; ''').fetchone()
+        source_version = None if source_version is None else source_version[0]
+        if source_version != SCHEMA_VERSION:
+            LOGGER.error(f'Source database schema version ({source_version}) does not match program ({SCHEMA_VERSION})')
+            return None
+
+        cur.execute(f'''
+            SELECT s.replicate, s.project FROM {MERGE_SOURCE}.replicates s
+            JOIN main.replicates r ON r.replicate = s.replicate AND r.project = s.project; ''')
+        duplicates = cur.fetchall()
+        if len(duplicates) > 0:
+            for rep, project in duplicates:
+                LOGGER.error(f"Replicate '{rep}' in project '{project}' is already in database!")
+            return None
+
+        counts = dict()
+        try:
+            cur.execute('BEGIN;')
+
+            # replicates
+            cur.execute(f'''
+                INSERT INTO main.replicates (replicate, project, includeRep, acquiredTime, acquiredRank, ticArea)
+                SELECT replicate, project, includeRep, acquiredTime, -1, ticArea
+                FROM {MERGE_SOURCE}.replicates ORDER BY replicateId; ''')
+            counts['replicates'] = cur.rowcount
+            cur.execute('''
+                CREATE TEMP TABLE mergeReplicateIds (
+                    sourceId INTEGER PRIMARY KEY, replicateId INTEGER NOT NULL); ''')
+            cur.execute(f'''
+                INSERT INTO temp.mergeReplicateIds (sourceId, replicateId)
+                SELECT s.replicateId, r.replicateId FROM {MERGE_SOURCE}.replicates s
+                JOIN main.replicates r ON r.replicate = s.replicate AND r.project = s.project; ''')
+
+            # proteins
+            counts['proteins'] = _merge_protein_ids(cur)
+            cur.execute(f'''
+                INSERT OR IGNORE INTO main.peptideToProtein (proteinId, modifiedSequence)
+                SELECT m.proteinId, s.modifiedSequence FROM {MERGE_SOURCE}.peptideToProtein s
+                JOIN temp.mergeProteinIds m ON m.sourceId = s.proteinId; ''')
+            counts['peptideToProtein'] = cur.rowcount
+
+            # precursors and proteinQuants
+            cur.execute(f'''
+                INSERT INTO main.precursors ({', '.join(PRECURSOR_COLS)})
+                SELECT m.replicateId, {', '.join(f's.{col}' for col in PRECURSOR_COLS[1:])}
+                FROM {MERGE_SOURCE}.precursors s
+                JOIN temp.mergeReplicateIds m ON m.sourceId = s.replicateId; ''')
+            counts['precursors'] = cur.rowcount
+            cur.execute(f'''
+                INSERT INTO main.proteinQuants (replicateId, proteinId, abundance, normalizedAbundance)
+                SELECT r.replicateId, p.proteinId, s.abundance, s.normalizedAbundance
+                FROM {MERGE_SOURCE}.proteinQuants s
+                JOIN temp.mergeReplicateIds r ON r.sourceId = s.replicateId
+                JOIN temp.mergeProteinIds p ON p.sourceId = s.proteinId; ''')
+            counts['proteinQuants'] = cur.rowcount
+
+            # sample metadata
+            cur.execute('SELECT annotationKey, annotationType FROM main.sampleMetadataTypes;')
+            types = {x[0]: Dtype[x[1]] for x in cur.fetchall()}
+            cur.execute(f'SELECT annotationKey, annotationType FROM {MERGE_SOURCE}.sampleMetadataTypes;')
+            new_types = {key: max(types[key], Dtype[value]) if key in types else Dtype[value]
+                         for key, value in cur.fetchall()}
+            cur.executemany('''
+                INSERT INTO main.sampleMetadataTypes (annotationKey, annotationType) VALUES (?, ?)
+                ON CONFLICT(annotationKey) DO UPDATE SET annotationType = excluded.annotationType; ''',
+                            [(key, str(dtype)) for key, dtype in new_types.items()])
+            cur.execute(f'''
+                INSERT INTO main.sampleMetadata (replicateId, annotationKey, annotationValue)
+                SELECT m.replicateId, s.annotationKey, s.annotationValue
+                FROM {MERGE_SOURCE}.sampleMetadata s
+                JOIN temp.mergeReplicateIds m ON m.sourceId = s.replicateId; ''')
+            counts['sampleMetadata'] = cur.rowcount
+
+            cur.execute('DROP TABLE temp.mergeReplicateIds;')
+            cur.execute('DROP TABLE temp.mergeProteinIds;')
+
+            cur.executemany('UPDATE main.replicates SET acquiredRank = ? WHERE replicateId = ?',
+                            _acquired_rank_updates(conn))
+            normalized = cur.execute("SELECT value FROM main.metadata WHERE key == 'is_normalized';").fetchone()
+            if normalized is not None and str(normalized[0]).lower() in ('true', '1'):
+                LOGGER.warning('Merged database is no longer normalized.')
+            cur.executemany('''
+                INSERT INTO main.metadata (key, value) VALUES (?, ?)
+                ON CONFLICT(key) DO UPDATE SET value = excluded.value; ''',
+                            [('replicates.acquiredRank updated', True), ('is_normalized', 'False')])
+            bump_cache_version(cur)
+        except sqlite3.Error as e:
+            conn.rollback()
+            LOGGER.error(f"Failed to merge '{source}': {e}")
+            return None
+        conn.commit()
+    finally:
+        cur.execute(f'DETACH DATABASE {MERGE_SOURCE};')
+
+    LOGGER.info(f"Merged {counts['precursors']} precursors from {counts['replicates']} replicates in '{source}'.")
+    return counts
+
+
+@memoize_query
+def _included_replicate_ids(conn):
+    ''' Get an array of replicateIds where includeRep is TRUE sorted by acquiredRank. '''
+    cur = conn.cursor()
+    cur.execute('''
+        SELECT replicateId FROM replicates
+        WHERE includeRep == TRUE
+        ORDER BY acquiredRank, replicateId; ''')
+    return np.array([x[0] for x in cur.fetchall()], dtype=np.int64)
+
+
+def _index_lookup(ids):
+    ''' Make an array mapping integer ids to their position in ids. Unused ids map to -1. '''
+    lookup = np.full((ids.max() + 1) if len(ids) > 0 else 0, -1, dtype=np.int64)
+    lookup[ids] = np.arange(len(ids))
+    return lookup
+
+
+def _fill_matrix(cur, query, row_lookup, col_lookup, dtype, chunk_size, params=()):
+    '''
+    Stream (rowId, replicateId, value) rows from query into a
+    len(row_lookup) x len(col_lookup) matrix initialized to NaN.
+    '''
+    n_rows = np.count_nonzero(row_lookup >= 0)
+    n_cols = np.count_nonzero(col_lookup >= 0)
+    mat = np.full((n_rows, n_cols), np.nan, dtype=dtype)
+
+    cur.execute(query, params)
+    while chunk := cur.fetchmany(chunk_size):
+        chunk = np.array(chunk, dtype=np.float64)
+        row_ids = chunk[:, 0].astype(np.int64)
+        col_ids = chunk[:, 1].astype(np.int64)
+
+        # skip replicates which are not included
+        cols = np.full(len(col_ids), -1, dtype=np.int64)
+        in_range = col_ids < len(col_lookup)
+        cols[in_range] = col_lookup[col_ids[in_range]]
+        sele = cols >= 0
+        mat[row_lookup[row_ids[sele]], cols[sele]] = chunk[sele, 2]
+
+    return mat
+
+
+def log2_transform(mat):
+    ''' log2 transform an array with values <= 0 set to NaN. '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(mat > 0, np.log2(mat), np.nan)
+
+
+def precursor_value_column(conn, value):
+    '''
+    Get the precursors column to use for matrix values.
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection:
+        Database connection.
+    value: str
+        A precursors value column. If None, normalizedArea is used if the
+        database is normalized, otherwise totalAreaFragment.
+
+    Returns
+    -------
+    column: str
+        The column name. None if value is not a valid column.
+    '''
+    if value is None:
+        return 'normalizedArea' if is_normalized(conn) else 'totalAreaFragment'
+    if value not in PRECURSOR_COLS[3:]:
+        LOGGER.error(f"'{value}' is not a precursors value column!")
+        return None
+    return value
+
+
+def iter_precursor_matrix(conn, value=None, replicate_batch_size=100,
+                          dtype=np.float64, chunk_size=100000):
+    '''
+    Iterate over wide precursor x replicate matrices for batches of replicates.
+
+    Every batch has the same rows so the batches can be concatenated column wise.
+    Only replicates where includeRep is TRUE are included.
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection:
+        Database connection.
+    value: str
+        The precursors column to use for matrix values. If None, normalizedArea
+        is used if the database is normalized, otherwise totalAreaFragment.
+    replicate_batch_size: int
+        Number of replicates in each batch. If None, all replicates are in one batch.
+    dtype: np.dtype
+        Matrix data type. np.float32 halves the size of the matrix.
+    chunk_size: int
+        Number of rows to fetch from the database at a time.
+
+    Yields
+    ------
+    mat: np.ndarray
+        Matrix with a row for each precursor and a column for each replicate in
+        the batch. Missing values are NaN.
+    rows: pd.MultiIndex
+        (modifiedSequence, precursorCharge) for each row in mat.
+    cols: pd.Index
+        replicateId for each column in mat sorted by acquiredRank.
+    '''
+    value = precursor_value_column(conn, value)
+    if value is None:
+        return
+
+    rep_ids = _included_replicate_ids(conn)
+    if replicate_batch_size is None:
+        replicate_batch_size = max(len(rep_ids), 1)
+
+    cur = conn.cursor()
+    cur.execute('DROP TABLE IF EXISTS temp.matrixRows;')
+    cur.execute('''
+        CREATE TEMP TABLE matrixRows (
+            rowId INTEGER PRIMARY KEY,
+            modifiedSequence TEXT NOT NULL,
+            precursorCharge INTEGER NOT NULL,
+            UNIQUE(modifiedSequence, precursorCharge)
+        ); ''')
+    try:
+        cur.execute('''
+            INSERT INTO matrixRows (modifiedSequence, precursorCharge)
+            SELECT DISTINCT p.modifiedSequence, p.precursorCharge
+            FROM precursors p
+            JOIN replicates r ON r.replicateId = p.replicateId
+            WHERE r.includeRep == TRUE
+            ORDER BY p.modifiedSequence, p.precursorCharge; ''')
+        cur.execute('SELECT rowId, modifiedSequence, precursorCharge FROM matrixRows ORDER BY rowId;')
+        row_keys = cur.fetchall()
+        row_lookup = _index_lookup(np.array([x[0] for x in row_keys], dtype=np.int64))
+        rows = pd.MultiIndex.from_tuples([x[1:] for x in row_keys],
+                                         names=['modifiedSequence', 'precursorCharge'])
+
+        query = f'''
+            SELECT m.rowId, p.replicateId, p.{value}
+            FROM precursors p
+            JOIN matrixRows m
+                ON m.modifiedSequence = p.modifiedSequence AND m.precursorCharge = p.precursorCharge '''
+        for start in range(0, len(rep_ids), replicate_batch_size):
+            batch_ids = rep_ids[start:start + replicate_batch_size]
+            if len(batch_ids) == len(rep_ids):
+                batch_query, params = query, ()
+            else:
+                batch_query = f"{query} WHERE p.replicateId IN ({', '.join(['?'] * len(batch_ids))})"
+                params = batch_ids.tolist()
+            mat = _fill_matrix(cur, batch_query, row_lookup, _index_lookup(batch_ids),
+                               dtype, chunk_size, params=params)
+            yield mat, rows, pd.Index(batch_ids, name='replicateId')
+    finally:
+        cur.execute('DROP TABLE IF EXISTS temp.matrixRows;')
+        conn.commit()
+
+
+def get_precursor_matrix(conn, value=None, dtype=np.float64, chunk_size=100000):
+    '''
+    Get a wide precursor x replicate matrix of a precursors column.
+
+    Values are streamed from the database directly into a preallocated
+    array, so the long table is never materialized in memory.
+    Only replicates where includeRep is TRUE are included.
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection:
+        Database connection.
+    value: str
+        The precursors column to use for matrix values. If None, normalizedArea
+        is used if the database is normalized, otherwise totalAreaFragment.
+    dtype: np.dtype
+        Matrix data type. np.float32 halves the size of the matrix.
+    chunk_size: int
+        Number of rows to fetch from the database at a time.
+
+    Returns
+    -------
+    mat: np.ndarray
+        Matrix with a row for each precursor and a column for each replicate.
+        Missing values are NaN.
+    rows: pd.MultiIndex
+        (modifiedSequence, precursorCharge) for each row in mat.
+    cols: pd.Index
+        replicateId for each column in mat sorted by acquiredRank.
+
+    A DataFrame can be made without copying the matrix with
+    pd.DataFrame(mat, index=rows, columns=cols, copy=False)
+    '''
+    batches = iter_precursor_matrix(conn, value=value, replicate_batch_size=None,
+                                    dtype=dtype, chunk_size=chunk_size)
+    ret = next(batches, None)
+    batches.close()
+    return ret
+
+
+@memoize_query(copy=False)
+def get_protein_matrix(conn, normalized=None, dtype=np.float64, chunk_size=100000):
+    '''
+    Get a wide protein x replicate matrix from the proteinQuants table.
+
+    Only replicates where includeRep is TRUE are included, and only proteins
+    with at least one value in an included replicate. Results are cached
+    with memoize_query. The returned matrix is read only, so it has to be
+    copied before it is modified.
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection:
+        Database connection.
+    normalized: bool
+        Use normalizedAbundance? If None, normalizedAbundance is used if the
+        database is normalized, otherwise abundance.
+    dtype: np.dtype
+        Matrix data type.
+    chunk_size: int
+        Number of rows to fetch from the database at a time.
+
+    Returns
+    -------
+    mat: np.ndarray
+        Matrix with a row for each protein and a column for each replicate.
+        Missing values are NaN.
+    rows: pd.Index
+        Protein name for each row in mat sorted by name and proteinId.
+    cols: pd.Index
+        replicateId for each column in mat sorted by acquiredRank.
+    '''
+    if normalized is None:
+        normalized = is_normalized(conn)
+    value = 'normalizedAbundance' if normalized else 'abundance'
+
+    rep_ids = _included_replicate_ids(conn)
+
+    cur = conn.cursor()
+    cur.execute(f'''
+        SELECT prot.proteinId, prot.name
+        FROM proteins prot
+        WHERE EXISTS (
+            SELECT 1 FROM proteinQuants q
+            JOIN replicates r ON r.replicateId = q.replicateId
+            WHERE q.proteinId = prot.proteinId AND r.includeRep == TRUE
+                AND q.{value} IS NOT NULL )
+        ORDER BY prot.name, prot.proteinId; ''')
+    row_keys = cur.fetchall()
+    protein_ids = np.array([x[0] for x in row_keys], dtype=np.int64)
+
+    mat = _fill_matrix(cur, f'SELECT proteinId, replicateId, {value} FROM proteinQuants',
+                       _index_lookup(protein_ids), _index_lookup(rep_ids), dtype, chunk_size)
+
+    return mat, pd.Index([x[1] for x in row_keys], name='protein'), pd.Index(rep_ids, name='replicateId')
+
+
 def validate_bit_mask(mask, n_options=3, n_digits=2):
     '''
     Validate bit mask command line argument
@@ -384,3 +1817,5 @@ def parse_bitmask_options(mask, digit_names, options):
         ret[key] = dict(zip(options, value))
     return ret
 
+
+instrument_module(__name__)
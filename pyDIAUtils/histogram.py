@@ -1,12 +1,16 @@
 
 import sqlite3
+import warnings
 import pandas as pd
-import matplotlib.pyplot as plt
-from matplotlib.ticker import MaxNLocator
 import numpy as np
 
+from .logger import LOGGER
+from .profiling import instrument_module
+from .plotting import get_pyplot
+
 
 def histogram(dat, xlab, ylab='Count', limits=None, fname=None, dpi=250):
+    plt = get_pyplot()
     fig, ax = plt.subplots(1, 1, figsize = (6, 4), dpi=dpi)
     ax.hist(dat, bins = 100)
     ax.set_xlabel(xlab)
@@ -22,34 +26,248 @@ def histogram(dat, xlab, ylab='Count', limits=None, fname=None, dpi=250):
     plt.close()
 
 
-def box_plot(data, ylab, xlab='Acquisition number', fname=None, hline=None, limits=None, dpi=250):
+def bin_counts(chunks, edges):
+    '''
+    Accumulate histogram counts over chunks of values with fixed bin edges.
 
-    # init plot
-    fig, ax = plt.subplots(1, 1, figsize = (10, 4), dpi=dpi)
+    Parameters
+    ----------
+    chunks: iterable
+        Iterable of array like chunks of values. NaN values are ignored.
+    edges: array like
+        Bin edges passed to np.histogram.
+
+    Returns
+    -------
+    counts: np.ndarray
+        Number of values in each bin.
+    '''
+    edges = np.asarray(edges, dtype=np.float64)
+    counts = np.zeros(len(edges) - 1, dtype=np.int64)
+    for chunk in chunks:
+        chunk = np.asarray(chunk, dtype=np.float64).ravel()
+        counts += np.histogram(chunk[~np.isnan(chunk)], bins=edges)[0]
+    return counts
+
+
+def db_bin_counts(conn, column, table='precursors', bins=100, limits=None, chunk_size=1000000):
+    '''
+    Calculate histogram counts for a database column without loading the whole column.
+
+    If table has a replicateId column, only replicates where includeRep is TRUE are used.
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection:
+        Database connection.
+    column: str
+        Column name.
+    table: str
+        Table name.
+    bins: int
+        Number of bins.
+    limits: tuple
+        (optional) (min, max) range of the bins. If None, the range is the
+        MIN and MAX of the column.
+    chunk_size: int
+        Number of values to fetch from the database at a time.
+
+    Returns
+    -------
+    counts: np.ndarray
+        Number of values in each bin.
+    edges: np.ndarray
+        Bin edges.
+    None if column is not in table.
+    '''
+    cur = conn.cursor()
+    table_cols = [row[1] for row in cur.execute('SELECT * FROM pragma_table_info(?);', (table,))]
+    if column not in table_cols:
+        LOGGER.error(f"'{column}' is not a column in table '{table}'!")
+        return None
+
+    where = f'{column} IS NOT NULL'
+    if 'replicateId' in table_cols:
+        where += ' AND replicateId IN (SELECT replicateId FROM replicates WHERE includeRep == TRUE)'
+
+    if limits is None:
+        cur.execute(f'SELECT MIN({column}), MAX({column}) FROM {table} WHERE {where};')
+        limits = cur.fetchone()
+        if limits[0] is None:
+            limits = (0, 1)
+    edges = np.linspace(limits[0], limits[1], bins + 1)
+
+    def _chunks():
+        cur.execute(f'SELECT {column} FROM {table} WHERE {where};')
+        while chunk := cur.fetchmany(chunk_size):
+            yield np.array(chunk, dtype=np.float64)
+
+    return bin_counts(_chunks(), edges), edges
+
+
+def binned_histogram(counts, edges, xlab, ylab='Count', limits=None, fname=None, dpi=250):
+    '''
+    Draw a histogram from precomputed bin counts.
+
+    Parameters
+    ----------
+    counts: np.ndarray
+        Number of values in each bin. See bin_counts and db_bin_counts.
+    edges: np.ndarray
+        Bin edges.
+    '''
+    plt = get_pyplot()
+    fig, ax = plt.subplots(1, 1, figsize = (6, 4), dpi=dpi)
+    ax.stairs(counts, edges, fill=True)
+    ax.set_xlabel(xlab)
+    ax.set_ylabel(ylab)
+
+    if limits:
+        plt.xlim(limits)
+
+    if fname:
+        plt.savefig(fname)
+    else:
+        plt.show()
+    plt.close()
+
+
+def box_stats(data, whis=1.5):
+    '''
+    Calculate box plot statistics for every column of data in one pass.
+
+    NaN values are ignored.
+
+    Parameters
+    ----------
+    data: np.ndarray or pd.DataFrame
+        Wide matrix with a column for each box.
+    whis: float
+        Whiskers extend to the most extreme value within whis * IQR of the box.
+
+    Returns
+    -------
+    stats: list
+        A list of dicts for each column which can be passed to Axes.bxp.
+    outlier_cols: np.ndarray
+        The column index of each outlier.
+    outliers: np.ndarray
+        The value of each outlier.
+    '''
+    data = np.asarray(data, dtype=np.float64)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        q1, med, q3 = np.nanpercentile(data, [25, 50, 75], axis=0)
+
+    iqr = q3 - q1
+    hi_val = q3 + whis * iqr
+    lo_val = q1 - whis * iqr
+
+    # comparisons with NaN are False so missing values are never whiskers or outliers
+    whis_hi = np.where(data <= hi_val, data, -np.inf).max(axis=0, initial=-np.inf)
+    whis_hi = np.where(whis_hi < q3, q3, whis_hi)
+    whis_lo = np.where(data >= lo_val, data, np.inf).min(axis=0, initial=np.inf)
+    whis_lo = np.where(whis_lo > q1, q1, whis_lo)
+    whis_hi[np.isnan(q3)] = np.nan
+    whis_lo[np.isnan(q1)] = np.nan
+
+    outlier_rows, outlier_cols = np.nonzero((data > hi_val) | (data < lo_val))
+
+    stats = [{'med': m, 'q1': l, 'q3': h, 'whislo': wl, 'whishi': wh}
+             for m, l, h, wl, wh in zip(med, q1, q3, whis_lo, whis_hi)]
+    return stats, outlier_cols, data[outlier_rows, outlier_cols]
+
+
+def group_columns(data, max_groups):
+    '''
+    Pool the values in consecutive columns of a wide matrix into at most max_groups columns.
+
+    Parameters
+    ----------
+    data: np.ndarray or pd.DataFrame
+        Wide matrix with columns sorted by acquisition order.
+    max_groups: int
+        Maximum number of groups.
+
+    Returns
+    -------
+    grouped: np.ndarray
+        Matrix with a column for each group containing all the values
+        in the group. Groups with fewer columns are padded with NaN.
+    width: int
+        Number of columns in each group.
+    '''
+    data = np.asarray(data, dtype=np.float64)
+    n_rows, n_cols = data.shape
+    width = max(1, -(-n_cols // max_groups))
+    if width == 1:
+        return data, width
+
+    n_groups = -(-n_cols // width)
+    padded = np.full((n_rows, n_groups * width), np.nan)
+    padded[:, :n_cols] = data
+    grouped = padded.reshape(n_rows, n_groups, width).transpose(0, 2, 1).reshape(n_rows * width, n_groups)
+    return grouped, width
+
+
+def _draw_boxes(ax, data, max_boxes=None):
+    '''
+    Draw a box for each column in data with jittered outliers.
+    If max_boxes is set, consecutive columns are pooled into at most max_boxes boxes.
+    Returns the number of columns in each box.
+    '''
+    width = 1
+    if max_boxes is not None:
+        data, width = group_columns(data, max_boxes)
+
+    stats, outlier_cols, outliers = box_stats(data)
 
     # plot outliers as scatter
-    for i, c in enumerate(data.columns):
-        y = data[c]
-        q3, q1 = np.percentile(y, [75, 25])
-        iqr = q3 - q1
-        outliers = y[(y > q3 + (1.5 * iqr)) | (y < q1 - (1.5 * iqr))]
-        x = np.random.normal(i + 1, 0.04, size=len(outliers))
-        ax.scatter(x, outliers, c = 'black', s = 0.3, alpha = 0.5)
+    x = np.random.normal(outlier_cols + 1, 0.04)
+    ax.scatter(x, outliers, c = 'black', s = 0.3, alpha = 0.5)
+
+    ax.bxp(stats, showfliers=False)
+    return width
+
+
+def _set_acquisition_ticks(ax, n_cols, width=1):
+    ''' Label up to 6 boxes with the acquisition number of the first column in the box. '''
+    n_groups = -(-n_cols // width)
+    groups = np.linspace(0, n_groups - 1, num=min(6, n_groups), dtype=int)
+    ax.set_xticks(groups + 1, groups * width)
+
+
+def box_plot(data, ylab, xlab='Acquisition number', fname=None, hline=None, limits=None, dpi=250,
+             max_boxes=None):
+    '''
+    Draw a box plot with a box for each column in data.
+
+    Parameters
+    ----------
+    data: pd.DataFrame
+        Wide DataFrame with a column for each replicate sorted by acquiredRank.
+    max_boxes: int
+        (optional) Pool consecutive replicates into at most max_boxes boxes.
+        The default is to draw a box for every replicate.
+    '''
+    plt = get_pyplot()
+
+    # init plot
+    fig, ax = plt.subplots(1, 1, figsize = (10, 4), dpi=dpi)
 
     if hline is not None:
         plt.axhline(y=hline, color='black', linestyle=':', linewidth=1)
 
-    # plot boxes
-    ax.boxplot(data, showfliers=False)
+    # plot boxes and outliers
+    width = _draw_boxes(ax, data, max_boxes=max_boxes)
 
     if limits:
         plt.ylim(limits)
 
     ax.set_xlabel(xlab)
     ax.set_ylabel(ylab)
-    n_cols = len(data.columns)
-    plt.xticks(np.linspace(1, n_cols, num=min(6, n_cols), dtype=int),
-               np.linspace(0, n_cols - 1, num=min(6, n_cols), dtype=int))
+    _set_acquisition_ticks(ax, np.shape(data)[1], width)
 
     if fname:
         plt.savefig(fname)
@@ -60,7 +278,7 @@ def box_plot(data, ylab, xlab='Acquisition number', fname=None, hline=None, limi
 
 def multi_boxplot(dats, data_levels,
                   xlab='Acquisition number', ylab='Log2(Area)',
-                  fname=None, dpi=250):
+                  fname=None, dpi=250, max_boxes=None):
     '''
     Draw box plots with a row for each level in data_levels.
 
@@ -80,7 +298,10 @@ def multi_boxplot(dats, data_levels,
         The name of the file to save the plot.
     dpi: int
         250 is the default.
+    max_boxes: int
+        (optional) Pool consecutive replicates into at most max_boxes boxes.
     '''
+    plt = get_pyplot()
 
     fig, axs = plt.subplots(len(data_levels), 1,
                             figsize = (10, len(data_levels) * 3),
@@ -92,25 +313,15 @@ def multi_boxplot(dats, data_levels,
     # iterate through each level
     for level, index in data_levels.items():
 
-        # plot outliers as scatter
-        for i, c in enumerate(dats[level].columns):
-            y = dats[level][c]
-            q3, q1 = np.percentile(y, [75, 25])
-            iqr = q3 - q1
-            outliers = y[(y > q3 + (1.5 * iqr)) | (y < q1 - (1.5 * iqr))]
-            x = np.random.normal(i + 1, 0.04, size=len(outliers))
-            axs[index].scatter(x, outliers, c = 'black', s = 0.3, alpha = 0.5)
-
-        axs[index].boxplot(dats[level], showfliers=False) #, vert=False)
+        # plot boxes and outliers
+        width = _draw_boxes(axs[index], dats[level], max_boxes=max_boxes)
 
         if index == len(data_levels) - 1:
             axs[index].set_xlabel(xlab)
 
         axs[index].set_ylabel(ylab)
 
-        n_cols = len(dats[level].columns)
-        axs[index].set_xticks(np.linspace(1, n_cols, num=min(6, n_cols), dtype=int),
-                              np.linspace(0, n_cols - 1, num=min(6, n_cols), dtype=int))
+        _set_acquisition_ticks(axs[index], np.shape(dats[level])[1], width)
         axs[index].set_title(level)
 
     if fname:
@@ -119,3 +330,5 @@ def multi_boxplot(dats, data_levels,
         plt.show()
     plt.close()
 
+
+instrument_module(__name__)
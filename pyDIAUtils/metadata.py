@@ -47,6 +47,41 @@ class Dtype(Enum):
         return val
 
 
+    def convert_column(self, values):
+        '''
+        Convert a column of strings to the pandas dtype for self.
+
+        NA strings and missing values are converted to NA.
+        BOOL columns are converted to the nullable 'boolean' dtype, INT to 'Int64',
+        FLOAT to 'float64', STRING to 'category', and NULL to an all NaN 'float64'.
+
+        Parameters
+        ----------
+        values: pd.Series
+            The strings to convert.
+
+        Returns
+        -------
+        pd.Series
+        '''
+        import numpy as np
+        import pandas as pd
+
+        values = values.astype(object)
+        values = values.mask(values.isna() | (values == '') |
+                             values.str.match(NA_RE.pattern, na=False))
+
+        if self is Dtype.NULL:
+            return pd.Series(np.nan, index=values.index, name=values.name, dtype='float64')
+        if self is Dtype.BOOL:
+            return values.str.lower().map({'true': True, 'false': False}).astype('boolean')
+        if self is Dtype.INT:
+            return pd.to_numeric(values, errors='coerce').astype('Int64')
+        if self is Dtype.FLOAT:
+            return pd.to_numeric(values, errors='coerce').astype('float64')
+        return values.astype('category')
+
+
     @staticmethod
     def infer_type(s):
         '''
@@ -70,3 +105,44 @@ class Dtype(Enum):
         if FLOAT_RE.search(s):
             return Dtype.FLOAT
         return Dtype.STRING
+
+
+    @staticmethod
+    def infer_column_type(values):
+        '''
+        Infer the consolidated datatype for a column of strings.
+
+        The result is the same as the maximum of Dtype.infer_type for each
+        value, but each regex is tested against the whole column at once and
+        only against values not already matched by a more specific type.
+
+        Parameters
+        ----------
+        values: pd.Series, np.ndarray, or list
+            The strings to test. Missing values (None or NaN) are NULL.
+
+        Returns
+        -------
+        Dtype object
+        '''
+        import pandas as pd
+
+        # object dtype so the str methods use the same regex engine as infer_type
+        values = pd.Series(values, dtype=object)
+        values = values[values.notna()]
+        if len(values) == 0:
+            return Dtype.NULL
+
+        # short circuit if the first value is already a STRING
+        if Dtype.infer_type(values.iloc[0]) is Dtype.STRING:
+            return Dtype.STRING
+
+        values = values[~((values == '') | values.str.match(NA_RE.pattern, na=False))]
+        if len(values) == 0:
+            return Dtype.NULL
+
+        for dtype, regex in ((Dtype.BOOL, BOOL_RE), (Dtype.INT, INT_RE), (Dtype.FLOAT, FLOAT_RE)):
+            values = values[~values.str.match(regex.pattern, na=False)]
+            if len(values) == 0:
+                return dtype
+        return Dtype.STRING
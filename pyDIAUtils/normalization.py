@@ -0,0 +1,256 @@
+
+import sqlite3
+import warnings
+from time import perf_counter
+
+import numpy as np
+
+from .logger import LOGGER
+from .dia_db_utils import get_precursor_matrix, bump_cache_version, log2_transform
+
+NORMALIZATION_METHODS = ('median', 'quantile', 'cyclic_loess')
+
+
+def _median_normalize(log_mat):
+    ''' Shift each column so its median is the mean of the column medians. '''
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        medians = np.nanmedian(log_mat, axis=0)
+    return log_mat - medians + np.nanmean(medians)
+
+
+def _interp_sorted(sorted_mat, n_values, quantiles):
+    '''
+    Linearly interpolate quantiles of each column of a matrix sorted with NaN last.
+    n_values is the number of non-missing values in each column.
+    '''
+    n_safe = np.maximum(n_values, 1)
+    positions = np.clip(quantiles * n_safe - 0.5, 0, n_safe - 1)
+    lower = np.floor(positions).astype(np.int64)
+    upper = np.minimum(lower + 1, n_safe - 1)
+    frac = positions - lower
+    values = (np.take_along_axis(sorted_mat, lower, axis=0) * (1 - frac) +
+              np.take_along_axis(sorted_mat, upper, axis=0) * frac)
+    values[:, n_values == 0] = np.nan
+    return values
+
+
+def _quantile_normalize(log_mat):
+    '''
+    Quantile normalization allowing missing values.
+
+    The reference distribution is the mean of the quantile functions of each
+    column evaluated on a common grid. Each value is replaced by the reference
+    at its quantile in its own column.
+    '''
+    n_values = np.count_nonzero(~np.isnan(log_mat), axis=0)
+    n_grid = n_values.max() if len(n_values) > 0 else 0
+    if n_grid == 0:
+        return log_mat.copy()
+
+    order = np.argsort(log_mat, axis=0)
+    sorted_mat = np.take_along_axis(log_mat, order, axis=0)
+    grid = (np.arange(n_grid) + 0.5) / n_grid
+    reference = np.nanmean(_interp_sorted(sorted_mat, n_values, grid[:, None]), axis=1)
+
+    ranks = np.empty_like(order)
+    np.put_along_axis(ranks, order, np.arange(log_mat.shape[0])[:, None], axis=0)
+    quantiles = (ranks + 0.5) / np.maximum(n_values, 1)
+    normalized = np.interp(quantiles * n_grid - 0.5, np.arange(n_grid), reference)
+    normalized[np.isnan(log_mat)] = np.nan
+    return normalized.astype(log_mat.dtype, copy=False)
+
+
+def _cyclic_loess_normalize(log_mat, n_bins=20, iterations=3):
+    '''
+    Lightweight cyclic loess normalization.
+
+    Each column is compared to the row median instead of every other column,
+    and the loess curve of M against A is approximated by a piecewise linear
+    curve through the mean (A, M) of n_bins equal sized bins of A. The
+    reference is recomputed after each iteration.
+    '''
+    mat = log_mat.copy()
+    n_rows, n_cols = mat.shape
+    if n_rows == 0 or n_cols == 0:
+        return mat
+
+    for _ in range(iterations):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            reference = np.nanmedian(mat, axis=1)[:, None]
+        m_vals = mat - reference
+        a_vals = (mat + reference) / 2
+
+        order = np.argsort(a_vals, axis=0)
+        a_sorted = np.take_along_axis(a_vals, order, axis=0)
+        m_sorted = np.take_along_axis(m_vals, order, axis=0)
+        n_values = np.count_nonzero(~np.isnan(a_sorted), axis=0)
+        k_bins = np.maximum(np.minimum(n_bins, n_values), 1)
+
+        # bin means from cumulative sums at the bin boundaries
+        bounds = np.minimum(np.arange(n_bins + 1)[:, None] * n_values // k_bins, n_values)
+        sizes = np.diff(bounds, axis=0)
+        zeros = np.zeros((1, n_cols), dtype=np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            a_knots = np.diff(np.take_along_axis(np.vstack([zeros, np.nancumsum(a_sorted, axis=0)]), bounds, axis=0), axis=0) / sizes
+            m_knots = np.diff(np.take_along_axis(np.vstack([zeros, np.nancumsum(m_sorted, axis=0)]), bounds, axis=0), axis=0) / sizes
+
+        # interpolate between the knots on either side of each value
+        positions = np.clip((np.arange(n_rows)[:, None] + 0.5) * k_bins / np.maximum(n_values, 1) - 0.5, 0, k_bins - 1)
+        lower = np.floor(positions).astype(np.int64)
+        upper = np.minimum(lower + 1, k_bins - 1)
+        a_lower = np.take_along_axis(a_knots, lower, axis=0)
+        a_upper = np.take_along_axis(a_knots, upper, axis=0)
+        m_lower = np.take_along_axis(m_knots, lower, axis=0)
+        m_upper = np.take_along_axis(m_knots, upper, axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            frac = np.clip(np.where(a_upper > a_lower, (a_sorted - a_lower) / (a_upper - a_lower), 0), 0, 1)
+        fitted = np.empty_like(m_sorted)
+        np.put_along_axis(fitted, order, m_lower + frac * (m_upper - m_lower), axis=0)
+
+        mat = mat - fitted
+
+    return mat.astype(log_mat.dtype, copy=False)
+
+
+_NORMALIZATIONS = {'median': _median_normalize,
+                   'quantile': _quantile_normalize,
+                   'cyclic_loess': _cyclic_loess_normalize}
+
+
+def normalize_matrix(mat, method='median', **kwargs):
+    '''
+    Normalize the columns of a wide precursor x replicate matrix.
+
+    Values are normalized on a log2 scale and returned on a linear scale.
+    Values <= 0 are treated as missing.
+
+    Parameters
+    ----------
+    mat: np.ndarray
+        Matrix with a row for each precursor and a column for each replicate.
+        Missing values are NaN.
+    method: str
+        One of NORMALIZATION_METHODS:
+        'median': Center the median of each replicate.
+        'quantile': Quantile normalization allowing missing values.
+        'cyclic_loess': Lightweight cyclic loess. Accepts the n_bins and iterations
+        keyword arguments.
+    kwargs:
+        Additional arguments for the normalization method.
+
+    Returns
+    -------
+    normalized: np.ndarray
+        Normalized matrix with the same shape as mat.
+        None if method is not valid.
+    '''
+    if method not in NORMALIZATION_METHODS:
+        LOGGER.error(f"Unknown normalization method '{method}'! Must be one of {NORMALIZATION_METHODS}")
+        return None
+    return np.exp2(_NORMALIZATIONS[method](log2_transform(mat), **kwargs))
+
+
+def _normalized_rows(normalized, rows, cols, chunk_size):
+    '''
+    Yield (replicateId, modifiedSequence, precursorCharge, normalizedArea) tuples
+    for the non-missing values in normalized in matrix column order. Python
+    objects are only created for blocks of columns with about chunk_size values.
+    '''
+    seqs = rows.get_level_values('modifiedSequence').to_numpy()
+    charges = rows.get_level_values('precursorCharge').to_numpy()
+    rep_ids = cols.to_numpy()
+    block_size = max(1, chunk_size // max(len(rows), 1))
+    for start in range(0, normalized.shape[1], block_size):
+        col_i, row_i = np.nonzero(~np.isnan(normalized[:, start:start + block_size].T))
+        yield from zip(rep_ids[start + col_i].tolist(), seqs[row_i].tolist(),
+                       charges[row_i].tolist(), normalized[row_i, start + col_i].tolist())
+
+
+def normalize_precursors(conn, method='median', value='totalAreaFragment',
+                         dtype=np.float64, chunk_size=100000, **kwargs):
+    '''
+    Normalize precursor areas and write them to precursors.normalizedArea.
+
+    The wide matrix of value is normalized with normalize_matrix. Results are
+    written to a temp table and copied to precursors with a single
+    UPDATE ... FROM, then metadata.is_normalized is set to True, all in one
+    transaction. normalizedArea is set to NULL for precursors which are not
+    in the normalized matrix, including those in excluded replicates.
+    exclude_replicates and mark_all_reps_includced in dia_db_utils set
+    is_normalized back to False when the included replicates change.
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection:
+        Database connection.
+    method: str
+        One of NORMALIZATION_METHODS. See normalize_matrix.
+    value: str
+        The precursors column to normalize.
+    dtype: np.dtype
+        Matrix data type. np.float32 halves the memory used.
+    chunk_size: int
+        Number of rows to fetch from the database and write to the temp table at a time.
+    kwargs:
+        Additional arguments for the normalization method.
+
+    Returns
+    -------
+    stats: dict
+        A dict with the keys 'precursors', 'replicates' and 'seconds'.
+        None if the normalization failed.
+    '''
+    if method not in NORMALIZATION_METHODS:
+        LOGGER.error(f"Unknown normalization method '{method}'! Must be one of {NORMALIZATION_METHODS}")
+        return None
+
+    start_time = perf_counter()
+    matrix = get_precursor_matrix(conn, value=value, dtype=dtype, chunk_size=chunk_size)
+    if matrix is None:
+        return None
+    mat, rows, cols = matrix
+    normalized = normalize_matrix(mat, method=method, **kwargs)
+    del mat
+    LOGGER.debug(f'Normalized {normalized.shape[0]} precursors in {normalized.shape[1]} replicates '
+                 f'in {perf_counter() - start_time:.1f} seconds.')
+
+    n_precursors = int(np.count_nonzero(~np.isnan(normalized)))
+    values = _normalized_rows(normalized, rows, cols, chunk_size)
+
+    conn.commit()
+    cur = conn.cursor()
+    try:
+        cur.execute('BEGIN;')
+        cur.execute('DROP TABLE IF EXISTS temp.normalizedAreas;')
+        cur.execute('''
+            CREATE TEMP TABLE normalizedAreas (
+                replicateId INTEGER NOT NULL,
+                modifiedSequence TEXT NOT NULL,
+                precursorCharge INTEGER NOT NULL,
+                normalizedArea REAL NOT NULL); ''')
+        cur.executemany('INSERT INTO temp.normalizedAreas VALUES (?, ?, ?, ?);', values)
+
+        cur.execute('UPDATE precursors SET normalizedArea = NULL WHERE normalizedArea IS NOT NULL;')
+        cur.execute('''
+            UPDATE precursors SET normalizedArea = n.normalizedArea
+            FROM temp.normalizedAreas n
+            WHERE precursors.replicateId = n.replicateId AND
+                  precursors.modifiedSequence = n.modifiedSequence AND
+                  precursors.precursorCharge = n.precursorCharge; ''')
+        cur.execute('DROP TABLE temp.normalizedAreas;')
+
+        cur.execute('''
+            INSERT INTO metadata (key, value) VALUES ('is_normalized', 'True')
+            ON CONFLICT(key) DO UPDATE SET value = excluded.value; ''')
+        bump_cache_version(cur)
+    except sqlite3.Error as e:
+        conn.rollback()
+        LOGGER.error(f'Failed to update normalizedArea: {e}')
+        return None
+    conn.commit()
+
+    seconds = perf_counter() - start_time
+    LOGGER.info(f'Wrote {n_precursors} {method} normalized areas for {len(cols)} replicates in {seconds:.1f} seconds.')
+    return {'precursors': n_precursors, 'replicates': len(cols), 'seconds': seconds}
@@ -0,0 +1,283 @@
+
+import os
+import re
+import sqlite3
+from glob import glob
+
+from .logger import LOGGER
+from .dia_db_utils import SCHEMA, SCHEMA_VERSION, PRECURSOR_COLS, check_schema_version, insert_precursors
+
+# Column names and arrow types for each table written to Parquet.
+# Tables are listed in an order which satisfies their foreign key constraints.
+# 'dictionary' is a dictionary encoded string column.
+PARQUET_TABLES = {
+    'metadata': (('key', 'string'), ('value', 'string')),
+    'replicates': (('replicateId', 'int64'), ('replicate', 'string'), ('project', 'string'),
+                   ('includeRep', 'bool'), ('acquiredTime', 'string'),
+                   ('acquiredRank', 'int64'), ('ticArea', 'float64')),
+    'proteins': (('proteinId', 'int64'), ('accession', 'string'),
+                 ('name', 'string'), ('description', 'string')),
+    'peptideToProtein': (('proteinId', 'int64'), ('modifiedSequence', 'dictionary')),
+    'sampleMetadataTypes': (('annotationKey', 'string'), ('annotationType', 'string')),
+    'sampleMetadata': (('replicateId', 'int64'), ('annotationKey', 'dictionary'),
+                       ('annotationValue', 'string')),
+    'proteinQuants': (('replicateId', 'int64'), ('proteinId', 'int64'),
+                      ('abundance', 'float64'), ('normalizedAbundance', 'float64'))}
+
+# Precursors are partitioned into directories of replicate_batch_size replicates.
+# Peak areas are stored as float32.
+PRECURSOR_PARQUET_COLS = (('replicateId', 'int64'), ('modifiedSequence', 'dictionary'),
+                          ('precursorCharge', 'int16'), ('precursorMz', 'float64'),
+                          ('averageMassErrorPPM', 'float64'), ('totalAreaFragment', 'float32'),
+                          ('totalAreaMs1', 'float32'), ('normalizedArea', 'float32'),
+                          ('rt', 'float64'), ('minStartTime', 'float64'), ('maxEndTime', 'float64'),
+                          ('maxFwhm', 'float64'), ('libraryDotProduct', 'float64'),
+                          ('isotopeDotProduct', 'float64'))
+
+PRECURSOR_PARTITION = 'replicateBatch'
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        LOGGER.error('pyarrow is required to read and write Parquet files!')
+        return None
+    return pyarrow
+
+
+def _arrow_schema(pa, columns):
+    fields = list()
+    for name, type_name in columns:
+        if type_name == 'dictionary':
+            fields.append(pa.field(name, pa.dictionary(pa.int32(), pa.string())))
+        else:
+            fields.append(pa.field(name, pa.type_for_alias(type_name)))
+    return pa.schema(fields)
+
+
+def _arrow_array(pa, values, arrow_type):
+    # SQLite stores BOOL columns as integers
+    if arrow_type == pa.bool_():
+        return pa.array(values, type=pa.int64()).cast(pa.bool_())
+    return pa.array(values, type=arrow_type)
+
+
+def _write_query(pa, cur, query, params, schema, fname, chunk_size):
+    '''
+    Stream the result of a query to a Parquet file with one row group per chunk.
+
+    Returns
+    -------
+    n_rows: int
+    '''
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    cur.execute(query, params)
+    n_rows = 0
+    with pa.parquet.ParquetWriter(fname, schema) as writer:
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if len(rows) == 0:
+                break
+            cols = zip(*rows)
+            batch = pa.record_batch([_arrow_array(pa, values, field.type)
+                                     for values, field in zip(cols, schema)], schema=schema)
+            writer.write_batch(batch)
+            n_rows += len(rows)
+    return n_rows
+
+
+def export_parquet(conn, out_dir, replicate_batch_size=100, chunk_size=100000):
+    '''
+    Export all the tables in a database to Parquet files.
+
+    Each table is written to out_dir/<table>.parquet except precursors, which is
+    written to out_dir/precursors/replicateBatch=<n>/part-0.parquet with
+    replicate_batch_size replicates in each partition. Peak areas are stored
+    as float32 and modifiedSequence is dictionary encoded. Tables are streamed
+    so the database is never read into memory all at once.
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection:
+        Database connection.
+    out_dir: str
+        Output directory. Must be empty or not exist.
+    replicate_batch_size: int
+        Number of replicates in each precursor partition.
+    chunk_size: int
+        Number of rows fetched from the database and written to each Parquet row group.
+
+    Returns
+    -------
+    counts: dict
+        A dict mapping table names to the number of rows written.
+        None if the export failed.
+    '''
+    pa = _import_pyarrow()
+    if pa is None:
+        return None
+    if not check_schema_version(conn):
+        return None
+    if os.path.isdir(out_dir) and len(os.listdir(out_dir)) > 0:
+        LOGGER.error(f"Output directory '{out_dir}' is not empty!")
+        return None
+
+    cur = conn.cursor()
+    counts = dict()
+    for table, columns in PARQUET_TABLES.items():
+        query = f"SELECT {', '.join(col for col, _ in columns)} FROM {table};"
+        counts[table] = _write_query(pa, cur, query, (), _arrow_schema(pa, columns),
+                                     os.path.join(out_dir, f'{table}.parquet'), chunk_size)
+        LOGGER.debug(f'Wrote {counts[table]} rows from {table} table.')
+
+    cur.execute('SELECT replicateId FROM replicates ORDER BY replicateId;')
+    rep_ids = [x[0] for x in cur.fetchall()]
+    schema = _arrow_schema(pa, PRECURSOR_PARQUET_COLS)
+    query = f'''
+        SELECT {', '.join(col for col, _ in PRECURSOR_PARQUET_COLS)}
+        FROM precursors WHERE replicateId BETWEEN ? AND ?; '''
+    counts['precursors'] = 0
+    for batch_i, start in enumerate(range(0, len(rep_ids), replicate_batch_size)):
+        batch = rep_ids[start:start + replicate_batch_size]
+        fname = os.path.join(out_dir, 'precursors', f'{PRECURSOR_PARTITION}={batch_i}', 'part-0.parquet')
+        counts['precursors'] += _write_query(pa, cur, query, (batch[0], batch[-1]),
+                                             schema, fname, chunk_size)
+        LOGGER.debug(f'Wrote {counts["precursors"]} precursor rows.')
+
+    LOGGER.info(f"Exported {counts['precursors']} precursors from {len(rep_ids)} replicates to '{out_dir}'.")
+    return counts
+
+
+def _precursor_partitions(in_dir):
+    ''' Get the precursor Parquet files in in_dir sorted by partition. '''
+    def partition(fname):
+        match = re.search(rf'{PRECURSOR_PARTITION}=(\d+)', fname)
+        return (int(match.group(1)) if match else -1, fname)
+    return sorted(glob(os.path.join(in_dir, 'precursors', '*', '*.parquet')), key=partition)
+
+
+def read_precursor_columns(in_dir, columns=None, memory_map=True):
+    '''
+    Read columns from the precursor Parquet files written by export_parquet.
+
+    Parameters
+    ----------
+    in_dir: str
+        Directory written by export_parquet.
+    columns: list
+        (optional) The columns to read. If None, all columns are read.
+    memory_map: bool
+        Memory map the files instead of reading them into memory.
+
+    Returns
+    -------
+    table: pyarrow.Table
+        None if pyarrow is not installed.
+    '''
+    pa = _import_pyarrow()
+    if pa is None:
+        return None
+    tables = [pa.parquet.read_table(fname, columns=columns, memory_map=memory_map)
+              for fname in _precursor_partitions(in_dir)]
+    if len(tables) == 0:
+        return _arrow_schema(pa, PRECURSOR_PARQUET_COLS).empty_table().select(
+            columns if columns is not None else [col for col, _ in PRECURSOR_PARQUET_COLS])
+    return pa.concat_tables(tables)
+
+
+def _parquet_rows(pa, fname, columns, batch_size):
+    ''' Iterate over the rows in a Parquet file as tuples. '''
+    parquet_file = pa.parquet.ParquetFile(fname)
+    for batch in parquet_file.iter_batches(batch_size=batch_size, columns=list(columns)):
+        yield from zip(*[col.to_pylist() for col in batch.columns])
+
+
+def import_parquet(conn, in_dir, batch_size=100000):
+    '''
+    Import a directory written by export_parquet into an empty database.
+
+    If the database does not have any tables, the schema is created.
+    All tables other than precursors are written in a single transaction.
+    Precursors are then loaded with insert_precursors. If loading precursors
+    fails, the rows written to the other tables are deleted. Peak areas are
+    imported with the float32 precision they were exported with.
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection:
+        Database connection.
+    in_dir: str
+        Directory written by export_parquet.
+    batch_size: int
+        Number of rows read from Parquet and inserted at a time.
+
+    Returns
+    -------
+    counts: dict
+        A dict mapping table names to the number of rows inserted.
+        None if the import failed.
+    '''
+    pa = _import_pyarrow()
+    if pa is None:
+        return None
+
+    missing = [table for table in PARQUET_TABLES
+               if not os.path.isfile(os.path.join(in_dir, f'{table}.parquet'))]
+    if len(missing) > 0:
+        LOGGER.error(f"Missing Parquet files for tables {missing} in '{in_dir}'!")
+        return None
+
+    metadata = dict(_parquet_rows(pa, os.path.join(in_dir, 'metadata.parquet'), ('key', 'value'), batch_size))
+    if metadata.get('schema_version') != SCHEMA_VERSION:
+        LOGGER.error(f"Exported schema version ({metadata.get('schema_version')}) does not match program ({SCHEMA_VERSION})")
+        return None
+
+    cur = conn.cursor()
+    cur.execute("SELECT COUNT(*) FROM sqlite_master WHERE type == 'table' AND name == 'replicates';")
+    if cur.fetchone()[0] == 0:
+        for command in SCHEMA:
+            cur.execute(command)
+    elif cur.execute('SELECT COUNT(*) FROM replicates;').fetchone()[0] > 0:
+        LOGGER.error('Parquet files can only be imported into an empty database!')
+        return None
+
+    counts = dict()
+    try:
+        if not conn.in_transaction:
+            cur.execute('BEGIN;')
+        for table, columns in PARQUET_TABLES.items():
+            col_names = [col for col, _ in columns]
+            cur.executemany(f'''
+                INSERT INTO {table} ({', '.join(col_names)})
+                VALUES ({', '.join(['?'] * len(col_names))}) ''',
+                            _parquet_rows(pa, os.path.join(in_dir, f'{table}.parquet'), col_names, batch_size))
+            counts[table] = cur.rowcount
+            LOGGER.debug(f'Inserted {counts[table]} rows into {table} table.')
+    except sqlite3.Error as e:
+        conn.rollback()
+        LOGGER.error(f'Failed to import Parquet files: {e}')
+        return None
+    conn.commit()
+
+    columns = ('replicateId',) + PRECURSOR_COLS[1:]
+    rows = (row for fname in _precursor_partitions(in_dir)
+            for row in _parquet_rows(pa, fname, columns, batch_size))
+    stats = insert_precursors(conn, rows, columns=columns, batch_size=batch_size)
+    if stats is None:
+        # the database was empty, so removing every row undoes the import
+        try:
+            cur.execute('BEGIN;')
+            for table in reversed(list(PARQUET_TABLES)):
+                cur.execute(f'DELETE FROM {table};')
+        except sqlite3.Error as e:
+            conn.rollback()
+            LOGGER.error(f'Failed to remove partially imported tables: {e}')
+            return None
+        conn.commit()
+        return None
+    counts['precursors'] = stats['rows']
+
+    LOGGER.info(f"Imported {counts['precursors']} precursors from {counts['replicates']} replicates.")
+    return counts
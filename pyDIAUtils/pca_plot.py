@@ -1,46 +1,335 @@
 
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.ticker import MaxNLocator
-from sklearn.preprocessing import StandardScaler
-from sklearn.decomposition import PCA
 
 from .metadata import Dtype
+from .logger import LOGGER
+from .profiling import instrument_module
+from .plotting import get_pyplot
 
-def pc_matrix(df):
-    df_s = StandardScaler().fit_transform(df.transpose())
+IMPUTE_METHODS = ('half_min', 'row_mean', 'knn')
 
-    pca = PCA()
-    pca.fit(df_s)
 
-    df_s = pd.DataFrame(df_s.transpose(), index=df.index, columns=df.columns)
-    pc = np.matmul(df_s.transpose(), pca.components_.transpose())
-    pc_var = (pca.singular_values_ ** 2) / sum(pca.singular_values_ ** 2) * 100
+def _fill_rows(mat, missing, fill):
+    ''' Set missing values in each row of mat to the value in fill for the row. '''
+    rows, cols = np.nonzero(missing)
+    mat[rows, cols] = fill[rows]
+
+
+def _row_means(mat, missing):
+    ''' nanmean for each row without warnings for rows which are all missing. '''
+    n_observed = mat.shape[1] - missing.sum(axis=1)
+    sums = np.where(missing, 0, mat).sum(axis=1)
+    return np.divide(sums, n_observed, out=np.full(len(sums), np.nan, dtype=mat.dtype),
+                     where=n_observed > 0)
+
+
+def _knn_impute(mat, missing, n_neighbors, block_size=10000):
+    '''
+    Fill missing values with the mean value of the feature in the n_neighbors
+    replicates closest to each replicate.
+
+    Distances between replicates are calculated from row centered values
+    with missing values set to the row mean. The matrix is processed in
+    blocks of block_size rows so only the replicate x replicate distance
+    matrix is held in memory in addition to mat.
+    '''
+    row_means = _row_means(mat, missing)
+
+    n_cols = mat.shape[1]
+    gram = np.zeros((n_cols, n_cols), dtype=np.float64)
+    for start in range(0, mat.shape[0], block_size):
+        block = slice(start, start + block_size)
+        centered = np.where(missing[block], 0, mat[block] - row_means[block, None])
+        gram += centered.transpose() @ centered
+
+    sq = np.diag(gram)
+    dists = sq[:, None] + sq[None, :] - 2 * gram
+    np.fill_diagonal(dists, np.inf)
+    neighbors = np.argsort(dists, axis=1)[:, :n_neighbors]
+
+    for col in np.nonzero(missing.any(axis=0))[0]:
+        rows = np.nonzero(missing[:, col])[0]
+        neighbor_missing = missing[np.ix_(rows, neighbors[col])]
+        values = np.where(neighbor_missing, 0, mat[np.ix_(rows, neighbors[col])])
+        n_observed = neighbor_missing.shape[1] - neighbor_missing.sum(axis=1)
+        mat[rows, col] = np.where(n_observed > 0,
+                                  values.sum(axis=1) / np.maximum(n_observed, 1),
+                                  row_means[rows])
+
+
+def impute_missing(mat, method='half_min', n_neighbors=5):
+    '''
+    Impute missing values in a feature x replicate matrix in place.
+
+    Parameters
+    ----------
+    mat: np.ndarray
+        Float matrix with a row for each feature and a column for each
+        replicate. Missing values are NaN.
+    method: str
+        One of IMPUTE_METHODS:
+        'half_min': Half of the minimum value of the feature.
+        'row_mean': Mean value of the feature.
+        'knn': Mean value of the feature in the n_neighbors closest replicates.
+            The feature mean is used if the feature is missing in every neighbor.
+    n_neighbors: int
+        Number of neighbors for 'knn'.
+
+    Returns
+    -------
+    mat: np.ndarray
+        mat with imputed values. Features missing in every replicate are still NaN.
+    '''
+    if method not in IMPUTE_METHODS:
+        raise ValueError(f"Unknown impute method '{method}'!")
+
+    missing = np.isnan(mat)
+    if not missing.any():
+        return mat
+
+    if method == 'half_min':
+        _fill_rows(mat, missing, np.where(missing, np.inf, mat).min(axis=1) / 2)
+        mat[np.isinf(mat) & missing] = np.nan
+    elif method == 'row_mean':
+        _fill_rows(mat, missing, _row_means(mat, missing))
+    else:
+        _knn_impute(mat, missing, n_neighbors)
+
+    return mat
+
+
+def pc_matrix(df, n_components=None, svd_solver='auto', random_state=None,
+              impute=None, max_missing=None, n_neighbors=5):
+    '''
+    Calculate principal components for the replicates in a wide DataFrame.
+
+    Parameters
+    ----------
+    df: pd.DataFrame
+        Wide DataFrame with a row for each feature and a column for each replicate.
+    n_components: int
+        Number of PCs to calculate. If None, all PCs are calculated.
+    svd_solver: str
+        sklearn PCA svd_solver. With n_components set, 'randomized' or 'arpack'
+        only calculate the first n_components PCs.
+    random_state: int
+        Random seed for the 'randomized' and 'arpack' solvers.
+    impute: str
+        (optional) Method in IMPUTE_METHODS to impute missing values.
+        See impute_missing.
+    max_missing: float
+        (optional) Remove features missing in more than this fraction of replicates.
+    n_neighbors: int
+        Number of neighbors for impute='knn'.
+
+    If impute or max_missing are set, a float32 copy of df is filtered and
+    imputed in place, and features which still have missing values are removed.
+    The number of features used is logged and stored in pc.attrs['n_features'].
+
+    Returns
+    -------
+    pc: pd.DataFrame
+        PC scores with a row for each replicate and a column for each PC.
+    pc_var: np.ndarray
+        Percent of total variance explained by each PC.
+    '''
+    from sklearn.preprocessing import StandardScaler
+    from sklearn.decomposition import PCA
+
+    copy = impute is None and max_missing is None
+    if copy:
+        mat = df.to_numpy()
+    else:
+        mat = df.to_numpy(dtype=np.float32, copy=True)
+        n_features = len(mat)
+
+        if max_missing is not None:
+            keep = np.isnan(mat).mean(axis=1) <= max_missing
+            if not keep.all():
+                mat = mat[keep]
+        if impute is not None:
+            impute_missing(mat, method=impute, n_neighbors=n_neighbors)
+
+        complete = ~np.isnan(mat).any(axis=1)
+        if not complete.all():
+            mat = mat[complete]
+        LOGGER.info(f'Using {len(mat)} of {n_features} features for PCA.')
+
+    # mat is only scaled in place if it is already a copy of df
+    df_s = StandardScaler(copy=copy).fit_transform(mat.transpose())
+
+    pca = PCA(n_components=n_components, svd_solver=svd_solver, random_state=random_state)
+    pc = pd.DataFrame(pca.fit_transform(df_s), index=df.columns)
+    pc_var = pca.explained_variance_ratio_ * 100
+    pc.attrs['n_features'] = len(mat)
+
+    return pc, pc_var
+
+
+def _feature_batch(batch):
+    ''' Get a feature x replicate array and replicate index from a batch '''
+    if isinstance(batch, pd.DataFrame):
+        return batch.to_numpy(), batch.columns
+    mat, _, cols = batch
+    return mat, cols
+
+
+def _feature_stats(batches):
+    '''
+    Get the number of replicates, and the number of missing values,
+    minimum, and mean of each feature over all batches.
+    '''
+    n_reps = 0
+    n_missing, mins, sums = None, None, None
+    for batch in batches():
+        mat, _ = _feature_batch(batch)
+        missing = np.isnan(mat)
+        if n_missing is None:
+            n_missing = np.zeros(len(mat), dtype=np.int64)
+            mins = np.full(len(mat), np.inf)
+            sums = np.zeros(len(mat))
+        n_reps += mat.shape[1]
+        n_missing += missing.sum(axis=1)
+        mins = np.minimum(mins, np.where(missing, np.inf, mat).min(axis=1, initial=np.inf))
+        sums += np.where(missing, 0, mat).sum(axis=1, dtype=np.float64)
+
+    n_observed = n_reps - n_missing
+    means = np.divide(sums, n_observed, out=np.full(len(sums), np.nan), where=n_observed > 0)
+    return n_reps, n_missing, mins, means
+
+
+def _impute_batch(batch, keep, fill, impute, n_neighbors):
+    '''
+    Get a replicate x feature float32 array and replicate index from a batch
+    with only the features in keep and missing values imputed.
+    '''
+    mat, cols = _feature_batch(batch)
+    mat = mat[keep].astype(np.float32)
+    missing = np.isnan(mat)
+    if missing.any():
+        if impute == 'knn':
+            _knn_impute(mat, missing, n_neighbors)
+            missing = np.isnan(mat)
+        _fill_rows(mat, missing, fill)
+    return mat.transpose(), cols
+
+
+def pc_matrix_incremental(batches, n_components=10, impute='row_mean', max_missing=None, n_neighbors=5):
+    '''
+    Calculate principal components with IncrementalPCA from batches of replicates.
+
+    Only one or two batches are in memory at a time. The batches are read
+    four times: to count missing values, to fit the scaler, to fit the PCA,
+    and to calculate scores.
+
+    Parameters
+    ----------
+    batches: callable
+        A function returning an iterator over batches of replicates. Each batch
+        is either a wide DataFrame with a column for each replicate, or a
+        (mat, rows, cols) tuple from dia_db_utils.iter_precursor_matrix.
+        All batches must have the same rows. For example:
+        lambda: dia_db_utils.iter_precursor_matrix(conn, replicate_batch_size=200)
+    n_components: int
+        Number of PCs to calculate.
+    impute: str
+        Method in IMPUTE_METHODS to impute missing values.
+        'half_min' and 'row_mean' use the feature minimum and mean over all
+        batches. 'knn' finds neighbors within each batch and falls back to the
+        feature mean over all batches.
+    max_missing: float
+        (optional) Remove features missing in more than this fraction of replicates.
+    n_neighbors: int
+        Number of neighbors for impute='knn'.
+
+    The same features are used for every batch. Features missing in more than
+    max_missing of all replicates are removed. If impute is None, features with
+    any missing values are removed, which removes almost every feature from a
+    precursor matrix. Otherwise features missing in every replicate are removed. The number of features used is logged and stored in pc.attrs['n_features'].
+
+    Returns
+    -------
+    pc: pd.DataFrame
+        PC scores with a row for each replicate and a column for each PC.
+    pc_var: np.ndarray
+        Percent of total variance explained by each PC.
+    '''
+    from sklearn.preprocessing import StandardScaler
+    from sklearn.decomposition import IncrementalPCA
+
+    if impute is not None and impute not in IMPUTE_METHODS:
+        raise ValueError(f"Unknown impute method '{impute}'!")
+
+    n_reps, n_missing, mins, means = _feature_stats(batches)
+    if n_missing is None:
+        raise ValueError('No batches to calculate PCs from!')
+    keep = n_missing < n_reps if impute is not None else n_missing == 0
+    if max_missing is not None:
+        keep &= n_missing / n_reps <= max_missing
+    fill = (mins / 2 if impute == 'half_min' else means)[keep]
+    LOGGER.info(f'Using {keep.sum()} of {len(keep)} features for PCA.')
+
+    def imputed_batches():
+        for batch in batches():
+            yield _impute_batch(batch, keep, fill, impute, n_neighbors)
+
+    scaler = StandardScaler()
+    for x, _ in imputed_batches():
+        scaler.partial_fit(x)
+
+    # Each partial_fit needs at least n_components replicates, so batches are
+    # accumulated until there are enough. A final batch which is too small is
+    # merged into the previous one.
+    pca = IncrementalPCA(n_components=n_components)
+    ready = None
+    pending = list()
+    for x, _ in imputed_batches():
+        pending.append(scaler.transform(x))
+        if sum(len(x) for x in pending) >= n_components:
+            if ready is not None:
+                pca.partial_fit(ready)
+            ready = np.vstack(pending)
+            pending = list()
+    if len(pending) > 0:
+        ready = np.vstack(pending if ready is None else [ready] + pending)
+    pca.partial_fit(ready)
+
+    scores = list()
+    index = list()
+    for x, cols in imputed_batches():
+        scores.append(pca.transform(scaler.transform(x)))
+        index.append(cols)
+
+    pc = pd.DataFrame(np.vstack(scores), index=index[0].append(index[1:]))
+    pc_var = pca.explained_variance_ratio_ * 100
+    pc.attrs['n_features'] = int(keep.sum())
 
     return pc, pc_var
 
 
 def pca_plot(pc, label_col, pc_var, label_type='discrete',
              fname=None, dpi=250, x_axis_pc=0, y_axis_pc=1, add_title=True):
+    from matplotlib.ticker import MaxNLocator
+    plt = get_pyplot()
 
     cmap = plt.get_cmap('viridis')
-    colors = {label: color for color, label in zip(cmap(np.linspace(0, 1, len(pc[label_col].drop_duplicates()))),
-                                                   pc[label_col].drop_duplicates())}
-    pc['color'] = pc[label_col].apply(lambda x: colors[x])
+    labels = pc[label_col].dropna().drop_duplicates()
+    colors = {label: color for color, label in zip(cmap(np.linspace(0, 1, len(labels))), labels)}
+    pc['color'] = pc[label_col].astype(object).map(colors)
 
     if label_type == 'discrete':
         fig = plt.figure(figsize = (6, 4), dpi=dpi)
         ax = fig.add_axes([0.1, 0.15, 0.65, 0.75])
 
-        for label in sorted(pc[label_col].drop_duplicates()):
-            sele = pc[label_col] == label
-            ax.scatter(pc[sele][x_axis_pc], pc[sele][y_axis_pc], color=colors[label], label=label)
+        for label, group in pc.groupby(label_col, sort=True, observed=True):
+            ax.scatter(group[x_axis_pc], group[y_axis_pc], color=colors[label], label=label)
         ax.legend(loc='upper left', bbox_to_anchor=(1.05, 1), title=label_col, alignment='left')
 
     elif label_type == 'continuous':
         fig, ax = plt.subplots(1, 1, figsize=(6, 4), dpi=dpi)
-        points=ax.scatter(pc[x_axis_pc], pc[y_axis_pc], c=pc[label_col], cmap='viridis')
+        points=ax.scatter(pc[x_axis_pc], pc[y_axis_pc], cmap='viridis',
+                          c=pc[label_col].to_numpy(dtype='float64', na_value=np.nan))
         fig.colorbar(points, label=label_col, use_gridspec=False,
                      ticks=MaxNLocator(integer=True) if pd.api.types.is_integer_dtype(pc[label_col]) else None)
 
@@ -60,13 +349,16 @@ def pca_plot(pc, label_col, pc_var, label_type='discrete',
 
 def convert_string_cols(df):
     '''
-    Convert string annotation key columns in DataFrame to annotationType
+    Pivot long annotation DataFrame with the columns replicateId, key, value, and type
+    to a wide DataFrame with a typed column for each annotation key.
     '''
 
     types = {row.key: Dtype[row.type] for row in df[['key', 'type']].drop_duplicates().itertuples()}
     ret = df.pivot(index="replicateId", columns="key", values="value")
-    for column in ret.columns:
-        ret[column] = ret[column].apply(lambda x: types[column].convert(x))
+    ret = pd.DataFrame({column: types[column].convert_column(ret[column]) for column in ret.columns},
+                       index=ret.index)
 
     return ret.rename_axis(columns=None).reset_index()
 
+
+instrument_module(__name__)
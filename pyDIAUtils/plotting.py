@@ -0,0 +1,35 @@
+
+import os
+import sys
+
+
+def _has_display():
+    ''' Determine if an interactive backend could be used. '''
+    if sys.platform.startswith('linux'):
+        return bool(os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY'))
+    return True
+
+
+def get_pyplot():
+    '''
+    Import and return matplotlib.pyplot.
+
+    pyplot is only imported the first time a plot is drawn instead of when the
+    plotting modules are imported. If no backend was selected (with MPLBACKEND or
+    matplotlib.use) and there is no display, the non-interactive Agg backend is
+    selected so matplotlib does not search for an interactive backend.
+    Matplotlib versions before 3.10 can not report whether a backend was selected
+    without resolving one, so with those versions matplotlib picks the backend.
+    '''
+    if 'matplotlib.pyplot' not in sys.modules and not _has_display():
+        import matplotlib
+        try:
+            # None until a backend is selected or resolved
+            backend = matplotlib.get_backend(auto_select=False)
+        except TypeError:
+            backend = 'unknown'
+        if backend is None:
+            matplotlib.use('Agg')
+
+    import matplotlib.pyplot as plt
+    return plt
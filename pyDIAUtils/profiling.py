@@ -0,0 +1,240 @@
+
+import os
+import sys
+import json
+import atexit
+import inspect
+import sqlite3
+import threading
+import functools
+import tracemalloc
+from time import perf_counter
+
+from .logger import LOGGER
+
+# Set to a file path to profile all instrumented functions and write the results
+# to the file at exit, or to 1 to only collect them in memory.
+PROFILE_ENV = 'PYDIAUTILS_PROFILE'
+
+# Format of the file written at exit. Either 'chrome' or 'json'.
+PROFILE_FORMAT_ENV = 'PYDIAUTILS_PROFILE_FORMAT'
+
+# Set to 1 to also record the SQL statements run by instrumented functions.
+# sqlite3 can not read back a connection's trace callback, so while SQL is
+# traced any callback set by the caller is replaced, and it is removed
+# when the outermost instrumented function using the connection returns.
+PROFILE_SQL_ENV = 'PYDIAUTILS_PROFILE_SQL'
+
+# Maximum number of characters of each SQL statement recorded.
+MAX_SQL_LENGTH = 200
+
+ENABLED = os.environ.get(PROFILE_ENV, '').lower() not in ('', '0', 'false')
+TRACE_SQL = ENABLED and os.environ.get(PROFILE_SQL_ENV, '').lower() not in ('', '0', 'false')
+
+_RECORDS = list()
+_RECORDS_LOCK = threading.Lock()
+_STATE = threading.local()
+_EPOCH = perf_counter()
+
+
+def _stack():
+    if not hasattr(_STATE, 'stack'):
+        _STATE.stack = list()
+        _STATE.traced = dict()
+    return _STATE.stack
+
+
+def _n_rows(value):
+    ''' Get the number of rows in a function return value. None if value does not have rows. '''
+    if isinstance(value, tuple) and len(value) > 0:
+        value = value[0]
+    shape = getattr(value, 'shape', None)
+    if shape is not None:
+        return shape[0] if len(shape) > 0 else None
+    if isinstance(value, list):
+        return len(value)
+    return None
+
+
+def _connection(args, kwargs):
+    ''' Get the first sqlite3.Connection in a function's arguments. '''
+    for arg in (*args, *kwargs.values()):
+        if isinstance(arg, sqlite3.Connection):
+            return arg
+    return None
+
+
+def _close_statement(frame, end):
+    ''' Set the duration of the last SQL statement started in frame. '''
+    if len(frame['sql']) > 0 and frame['sql'][-1]['seconds'] is None:
+        frame['sql'][-1]['seconds'] = end - frame['sql'][-1]['start']
+
+
+def _trace_statement(statement):
+    '''
+    sqlite3 trace callback. A statement is assumed to run until the next
+    statement starts or the function which executed it returns.
+    '''
+    stack = _stack()
+    if len(stack) == 0:
+        return
+    now = perf_counter() - _EPOCH
+    frame = stack[-1]
+    _close_statement(frame, now)
+    frame['sql'].append({'sql': statement[:MAX_SQL_LENGTH], 'start': now, 'seconds': None})
+
+
+def profiled(fxn):
+    '''
+    Decorator to record the wall time, number of rows returned, peak memory
+    allocated (with tracemalloc) and SQL statements run by a function.
+
+    If profiling is not enabled with the PYDIAUTILS_PROFILE environment
+    variable, fxn is returned unchanged. SQL statements are only recorded if
+    PYDIAUTILS_PROFILE_SQL is also set, because tracing replaces the trace
+    callback of the function's connection. See PROFILE_SQL_ENV.
+    '''
+    if not ENABLED:
+        return fxn
+
+    name = f'{fxn.__module__}.{fxn.__qualname__}'
+
+    @functools.wraps(fxn)
+    def wrapper(*args, **kwargs):
+        stack = _stack()
+        conn = _connection(args, kwargs) if TRACE_SQL else None
+        if conn is not None:
+            if _STATE.traced.get(id(conn), 0) == 0:
+                conn.set_trace_callback(_trace_statement)
+            _STATE.traced[id(conn)] = _STATE.traced.get(id(conn), 0) + 1
+
+        # The tracemalloc peak is reset for each call, so the peak seen so
+        # far is saved in the parent frame before it is reset.
+        current, peak = tracemalloc.get_traced_memory()
+        if len(stack) > 0:
+            stack[-1]['peak'] = max(stack[-1]['peak'], peak)
+            _close_statement(stack[-1], perf_counter() - _EPOCH)
+        tracemalloc.reset_peak()
+        frame = {'name': name, 'start': perf_counter() - _EPOCH, 'memory': current,
+                 'peak': current, 'sql': list(), 'depth': len(stack)}
+        stack.append(frame)
+
+        value = None
+        try:
+            value = fxn(*args, **kwargs)
+            return value
+        finally:
+            end = perf_counter() - _EPOCH
+            _close_statement(frame, end)
+            stack.pop()
+            peak = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+            if len(stack) > 0:
+                stack[-1]['peak'] = max(stack[-1]['peak'], peak)
+
+            if conn is not None:
+                _STATE.traced[id(conn)] -= 1
+                if _STATE.traced[id(conn)] == 0:
+                    del _STATE.traced[id(conn)]
+                    try:
+                        conn.set_trace_callback(None)
+                    except sqlite3.ProgrammingError:
+                        pass
+
+            record = {'name': name, 'start': frame['start'], 'seconds': end - frame['start'],
+                      'rows': _n_rows(value), 'peak_bytes': peak - frame['memory'],
+                      'depth': frame['depth'], 'pid': os.getpid(), 'thread': threading.get_ident(),
+                      'sql': frame['sql']}
+            with _RECORDS_LOCK:
+                _RECORDS.append(record)
+            LOGGER.debug(f"{name}: {record['seconds']:.3f} seconds, {len(frame['sql'])} SQL statements, "
+                         f"{record['peak_bytes'] / 1048576:.1f} MiB peak.")
+
+    return wrapper
+
+
+def instrument_module(module_name):
+    '''
+    Wrap every public function defined in a module with profiled.
+    Generator functions are not wrapped because they return before doing any work.
+    Does nothing if profiling is not enabled.
+    '''
+    if not ENABLED:
+        return
+    module = sys.modules[module_name]
+    for name, value in list(vars(module).items()):
+        if (not name.startswith('_') and inspect.isfunction(value)
+                and not inspect.isgeneratorfunction(value)
+                and value.__module__ == module_name):
+            setattr(module, name, profiled(value))
+
+
+def get_records():
+    '''
+    Get the profiling records collected in this process.
+
+    Returns
+    -------
+    records: list
+        A dict for each call of an instrumented function with the keys 'name',
+        'start' and 'seconds' (relative to when profiling started), 'rows'
+        (rows in the returned value), 'peak_bytes' (peak memory allocated above
+        the memory in use when the function was called), 'depth', 'pid',
+        'thread', and 'sql' (a list of dicts with the keys 'sql', 'start' and 'seconds').
+    '''
+    with _RECORDS_LOCK:
+        return list(_RECORDS)
+
+
+def clear_records():
+    ''' Remove all the collected profiling records. '''
+    with _RECORDS_LOCK:
+        _RECORDS.clear()
+
+
+def export_json(fname):
+    ''' Write the profiling records to a JSON file. '''
+    with open(fname, 'w') as outF:
+        json.dump(get_records(), outF, indent=2)
+
+
+def export_chrome_trace(fname):
+    '''
+    Write the profiling records in the Chrome trace event format,
+    which can be opened with chrome://tracing or Perfetto.
+    '''
+    events = list()
+    for record in get_records():
+        events.append({'name': record['name'], 'cat': 'function', 'ph': 'X',
+                       'ts': record['start'] * 1e6, 'dur': record['seconds'] * 1e6,
+                       'pid': record['pid'], 'tid': record['thread'],
+                       'args': {'rows': record['rows'], 'peak_bytes': record['peak_bytes']}})
+        for statement in record['sql']:
+            events.append({'name': statement['sql'].strip().split(None, 1)[0] if statement['sql'].strip() else 'SQL',
+                           'cat': 'sql', 'ph': 'X',
+                           'ts': statement['start'] * 1e6, 'dur': (statement['seconds'] or 0) * 1e6,
+                           'pid': record['pid'], 'tid': record['thread'],
+                           'args': {'sql': statement['sql']}})
+    with open(fname, 'w') as outF:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, outF)
+
+
+def _export_at_exit(fname, fmt, pid):
+    # Forked worker processes inherit the handler but do not write the file.
+    if os.getpid() != pid or len(get_records()) == 0:
+        return
+    if fmt == 'json':
+        export_json(fname)
+    else:
+        export_chrome_trace(fname)
+    LOGGER.info(f"Wrote profile to '{fname}'.")
+
+
+if ENABLED:
+    tracemalloc.start()
+    _fname = os.environ[PROFILE_ENV]
+    if _fname.lower() not in ('1', 'true'):
+        _fmt = os.environ.get(PROFILE_FORMAT_ENV, 'chrome').lower()
+        if _fmt not in ('chrome', 'json'):
+            LOGGER.warning(f"Unknown {PROFILE_FORMAT_ENV} '{_fmt}'. Using 'chrome'.")
+            _fmt = 'chrome'
+        atexit.register(_export_at_exit, _fname, _fmt, os.getpid())
@@ -0,0 +1,250 @@
+
+import sqlite3
+import warnings
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+
+from .logger import LOGGER
+from .dia_db_utils import iter_precursor_matrix, precursor_value_column, bulk_upsert, log2_transform
+
+ROLLUP_METHODS = ('top_n', 'median_log2', 'maxlfq')
+
+
+def _group_starts(groups):
+    ''' Get the index of the first row of each group in a sorted array of group codes. '''
+    return np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+
+
+def _sort_within_groups(mat, groups, descending=False):
+    '''
+    Sort the values in each column of mat within each group of rows.
+    groups must be sorted. NaN values are sorted to the end of each group.
+    '''
+    order = np.argsort(-mat if descending else mat, axis=0, kind='stable')
+    order = np.take_along_axis(order, np.argsort(groups[order], axis=0, kind='stable'), axis=0)
+    return np.take_along_axis(mat, order, axis=0)
+
+
+def _group_median(mat, groups):
+    ''' Median of the non-missing values in each column for each group of rows. '''
+    starts = _group_starts(groups)
+    mat = _sort_within_groups(mat, groups)
+    n_values = np.add.reduceat(~np.isnan(mat), starts, axis=0)
+
+    lower = starts[:, None] + np.maximum(n_values - 1, 0) // 2
+    upper = starts[:, None] + n_values // 2
+    upper = np.where(n_values > 0, upper, lower)
+    medians = (np.take_along_axis(mat, lower, axis=0) + np.take_along_axis(mat, upper, axis=0)) / 2
+    medians[n_values == 0] = np.nan
+    return medians
+
+
+def _rollup_top_n(mat, groups, n):
+    ''' Sum of the n most abundant precursors in each replicate. '''
+    starts = _group_starts(groups)
+    mat = _sort_within_groups(mat, groups, descending=True)
+    position = np.arange(len(groups)) - np.repeat(starts, np.diff(np.r_[starts, len(groups)]))
+    selected = (position < n)[:, None] & ~np.isnan(mat)
+
+    sums = np.add.reduceat(np.where(selected, mat, 0), starts, axis=0)
+    sums[np.add.reduceat(selected, starts, axis=0) == 0] = np.nan
+    return sums
+
+
+def _rollup_median_log2(mat, groups, n):
+    ''' Median of log2 precursor areas, transformed back to a linear scale. '''
+    return np.exp2(_group_median(log2_transform(mat), groups))
+
+
+def _rollup_maxlfq(mat, groups, n):
+    '''
+    MaxLFQ-style ratio based abundance.
+
+    Instead of solving for every pairwise replicate ratio, each precursor is
+    aligned to a reference precursor (the precursor in the protein with the
+    most values) by the median log2 ratio over the replicates where both were
+    quantified. The protein abundance in each replicate is the median of the
+    aligned precursors, so ratios between replicates are preserved and the
+    cost is linear in the number of replicates.
+    '''
+    log_mat = log2_transform(mat)
+    n_values = np.count_nonzero(~np.isnan(log_mat), axis=1)
+
+    # most complete precursor in each group
+    order = np.lexsort((-n_values, groups))
+    reference = order[_group_starts(groups[order])][groups]
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        shifts = np.nanmedian(log_mat - log_mat[reference], axis=1)
+
+    return np.exp2(_group_median(log_mat - shifts[:, None], groups))
+
+
+_ROLLUPS = {'top_n': _rollup_top_n,
+            'median_log2': _rollup_median_log2,
+            'maxlfq': _rollup_maxlfq}
+
+
+def _rollup(conn, method, n, value, replicate_batch_size, dtype, chunk_size):
+    '''
+    Compute protein abundances. Returns a tuple of the protein x replicate matrix,
+    an array of proteinIds and protein names for each row, and an array of replicateIds.
+    '''
+    rollup = _ROLLUPS[method]
+    if method == 'maxlfq':
+        replicate_batch_size = None
+
+    peptides = pd.read_sql('''
+        SELECT prot.proteinId, prot.name, ptp.modifiedSequence
+        FROM peptideToProtein ptp
+        JOIN proteins prot ON prot.proteinId = ptp.proteinId; ''', conn)
+
+    pairs = None
+    mats, rep_ids = list(), list()
+    for mat, rows, cols in iter_precursor_matrix(conn, value=value, dtype=dtype, chunk_size=chunk_size,
+                                                 replicate_batch_size=replicate_batch_size):
+        if pairs is None:
+            pairs = peptides.merge(pd.DataFrame({'modifiedSequence': rows.get_level_values('modifiedSequence'),
+                                                 'row': np.arange(len(rows))}),
+                                   on='modifiedSequence')
+            pairs = pairs.sort_values(['name', 'proteinId', 'row'], kind='stable')
+            groups = pd.factorize(pairs['proteinId'])[0]
+            pair_rows = pairs['row'].to_numpy()
+            proteins = pairs.drop_duplicates('proteinId')
+        if len(pairs.index) > 0:
+            mats.append(rollup(mat[pair_rows], groups, n))
+        rep_ids.append(cols.to_numpy())
+
+    rep_ids = np.concatenate(rep_ids) if len(rep_ids) > 0 else np.empty(0, dtype=np.int64)
+    if len(mats) == 0:
+        LOGGER.warning('No precursors map to a protein in peptideToProtein!')
+        return (np.empty((0, len(rep_ids)), dtype=dtype), np.empty(0, dtype=np.int64),
+                np.empty(0, dtype=object), rep_ids)
+
+    mat = np.hstack(mats).astype(dtype, copy=False)
+    return mat, proteins['proteinId'].to_numpy(), proteins['name'].to_numpy(), rep_ids
+
+
+def protein_rollup_matrix(conn, method='top_n', n=3, value=None, replicate_batch_size=100,
+                          dtype=np.float64, chunk_size=100000):
+    '''
+    Compute a wide protein x replicate matrix of abundances from precursor areas.
+
+    Precursors are assigned to every protein their peptide maps to in
+    peptideToProtein. Only replicates where includeRep is TRUE are included.
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection:
+        Database connection.
+    method: str
+        One of ROLLUP_METHODS:
+        'top_n': Sum of the n most abundant precursors in each replicate.
+        'median_log2': Median of the log2 precursor areas.
+        'maxlfq': MaxLFQ-style estimate from the median log2 ratios between precursors.
+        Abundances are always returned on a linear scale.
+    n: int
+        Number of precursors summed by the 'top_n' method.
+    value: str
+        The precursors column to use. If None, normalizedArea is used if the
+        database is normalized, otherwise totalAreaFragment.
+    replicate_batch_size: int
+        Number of replicates read from the database at a time. The 'maxlfq'
+        method always reads all replicates at once.
+    dtype: np.dtype
+        Matrix data type. np.float32 halves the memory used.
+    chunk_size: int
+        Number of rows to fetch from the database at a time.
+
+    Returns
+    -------
+    mat: np.ndarray
+        Matrix with a row for each protein and a column for each replicate.
+        Missing values are NaN.
+    rows: pd.Index
+        Protein name for each row in mat.
+    cols: pd.Index
+        replicateId for each column in mat sorted by acquiredRank.
+        None if the method or value is not valid.
+    '''
+    if method not in ROLLUP_METHODS:
+        LOGGER.error(f"Unknown rollup method '{method}'! Must be one of {ROLLUP_METHODS}")
+        return None
+    value = precursor_value_column(conn, value)
+    if value is None:
+        return None
+
+    mat, _, names, rep_ids = _rollup(conn, method, n, value, replicate_batch_size, dtype, chunk_size)
+    return mat, pd.Index(names, name='protein'), pd.Index(rep_ids, name='replicateId')
+
+
+def rollup_proteins(conn, method='top_n', n=3, value=None, replicate_batch_size=100,
+                    dtype=np.float64, chunk_size=100000):
+    '''
+    Compute protein abundances from precursor areas and write them to the proteinQuants table.
+
+    Abundances are computed with protein_rollup_matrix. If value is normalizedArea
+    proteinQuants.normalizedAbundance is populated, otherwise proteinQuants.abundance.
+    Existing values in the column for included replicates are replaced in a single
+    transaction.
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection:
+        Database connection.
+    method: str
+        One of ROLLUP_METHODS. See protein_rollup_matrix.
+    n: int
+        Number of precursors summed by the 'top_n' method.
+    value: str
+        The precursors column to use. If None, normalizedArea is used if the
+        database is normalized, otherwise totalAreaFragment.
+    replicate_batch_size: int
+        Number of replicates read from the database at a time.
+    dtype: np.dtype
+        Matrix data type.
+    chunk_size: int
+        Number of rows to fetch from the database at a time.
+
+    Returns
+    -------
+    counts: dict
+        A dict with the number of rows 'inserted' and 'updated' in proteinQuants.
+        None if the rollup failed.
+    '''
+    if method not in ROLLUP_METHODS:
+        LOGGER.error(f"Unknown rollup method '{method}'! Must be one of {ROLLUP_METHODS}")
+        return None
+    value = precursor_value_column(conn, value)
+    if value is None:
+        return None
+    column = 'normalizedAbundance' if value == 'normalizedArea' else 'abundance'
+
+    start_time = perf_counter()
+    mat, protein_ids, _, rep_ids = _rollup(conn, method, n, value, replicate_batch_size, dtype, chunk_size)
+    LOGGER.debug(f'Computed {method} abundances for {len(protein_ids)} proteins in {perf_counter() - start_time:.1f} seconds.')
+
+    row_i, col_i = np.nonzero(~np.isnan(mat))
+    rows = zip(rep_ids[col_i].tolist(), protein_ids[row_i].tolist(), mat[row_i, col_i].tolist())
+
+    conn.commit()
+    cur = conn.cursor()
+    try:
+        cur.execute('BEGIN;')
+        cur.execute(f'''
+            UPDATE proteinQuants SET {column} = NULL
+            WHERE replicateId IN (SELECT replicateId FROM replicates WHERE includeRep == TRUE); ''')
+    except sqlite3.Error as e:
+        conn.rollback()
+        LOGGER.error(f'Failed to update proteinQuants table: {e}')
+        return None
+    counts = bulk_upsert(conn, 'proteinQuants', ('replicateId', 'proteinId'), (column,), rows)
+    if counts is None:
+        return None
+
+    LOGGER.info(f'Wrote {method} {column} values for {len(protein_ids)} proteins in {len(rep_ids)} replicates '
+                f'in {perf_counter() - start_time:.1f} seconds.')
+    return counts
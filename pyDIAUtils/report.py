@@ -0,0 +1,332 @@
+
+import os
+import json
+from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from .logger import LOGGER
+from .dia_db_utils import (REPORT_QUERIES, cached_query, connect_read_only, get_precursor_matrix,
+                           get_protein_matrix, is_normalized, precursor_value_column, log2_transform)
+
+PLOT_TYPES = ('histogram', 'box_plot', 'multi_boxplot', 'bar_chart', 'pca', 'rt')
+
+# Datasets shared by the plots being rendered. Set in worker processes by _init_worker.
+_REPORT_DATA = dict()
+
+ANNOTATION_QUERY = '''
+    SELECT s.replicateId, s.annotationKey AS key, s.annotationValue AS value, t.annotationType AS type
+    FROM sampleMetadata s
+    JOIN sampleMetadataTypes t ON t.annotationKey = s.annotationKey
+    JOIN replicates r ON r.replicateId = s.replicateId
+    WHERE r.includeRep == TRUE; '''
+
+
+def _plot_data_keys(conn, plot):
+    '''
+    Get the keys of the datasets needed to draw plot.
+    Equivalent datasets for different plots have the same key.
+    '''
+    def matrix_key(value):
+        column = precursor_value_column(conn, value)
+        if column is None:
+            raise ValueError(f"Invalid precursor value '{value}'")
+        return ('precursor_matrix', column)
+
+    kind = plot['type']
+    if kind == 'histogram':
+        limits = plot.get('limits')
+        return [('bins', plot.get('table', 'precursors'), plot['column'], plot.get('bins', 100),
+                 tuple(limits) if limits is not None else None)]
+    if kind in ('box_plot', 'bar_chart'):
+        return [matrix_key(plot.get('value'))]
+    if kind == 'multi_boxplot':
+        return [matrix_key(value) for value in plot['values']]
+    if kind == 'pca':
+        if plot.get('level', 'precursor') == 'protein':
+            normalized = plot.get('normalized')
+            matrix = ('protein_matrix', is_normalized(conn) if normalized is None else normalized)
+        else:
+            matrix = matrix_key(plot.get('value'))
+        return [matrix, ('replicates',), ('annotations',)]
+    if kind == 'rt':
+        return [('rts',)]
+    raise ValueError(f"Unknown plot type '{kind}'")
+
+
+def plan_report(conn, spec, out_dir):
+    '''
+    Plan the queries and rendering tasks for a report.
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection:
+        Database connection.
+    spec: list
+        A list of plot dicts. See run_report.
+    out_dir: str
+        Directory plots are written to.
+
+    Returns
+    -------
+    keys: list
+        Keys of the datasets to fetch. Each dataset is only fetched once.
+    tasks: list
+        A dict for each figure to render with the keys 'name', 'plot', 'keys' and 'fname'.
+    proteins: list
+        The proteins in all 'rt' plots.
+    None if the spec is not valid.
+    '''
+    keys = dict()
+    tasks = list()
+    proteins = dict()
+    for i, plot in enumerate(spec):
+        if plot.get('type') not in PLOT_TYPES:
+            LOGGER.error(f"Unknown plot type '{plot.get('type')}'! Must be one of {PLOT_TYPES}")
+            return None
+        name = plot.get('name', f"{plot['type']}_{i}")
+        try:
+            plot_keys = _plot_data_keys(conn, plot)
+        except (KeyError, ValueError) as e:
+            LOGGER.error(f"Invalid spec for plot '{name}': {e}")
+            return None
+        keys.update(dict.fromkeys(plot_keys))
+
+        if plot['type'] == 'rt':
+            for protein in plot['proteins']:
+                proteins[protein] = None
+                tasks.append({'name': f'{name}_{protein}', 'plot': {**plot, 'protein': protein},
+                              'keys': plot_keys, 'fname': os.path.join(out_dir, f'{name}_{protein}.png')})
+        else:
+            tasks.append({'name': name, 'plot': plot, 'keys': plot_keys,
+                          'fname': os.path.join(out_dir, f'{name}.png')})
+
+    return list(keys), tasks, list(proteins)
+
+
+def _key_name(key):
+    return ':'.join(str(x) for x in key if x is not None)
+
+
+def _fetch(conn, key, proteins):
+    ''' Fetch the dataset for key. '''
+    kind = key[0]
+    if kind == 'precursor_matrix':
+        return get_precursor_matrix(conn, value=key[1])
+    if kind == 'protein_matrix':
+        return get_protein_matrix(conn, normalized=key[1])
+    if kind == 'bins':
+        from .histogram import db_bin_counts
+        _, table, column, bins, limits = key
+        return db_bin_counts(conn, column, table=table, bins=bins, limits=limits)
+    if kind == 'replicates':
+        return cached_query(conn, REPORT_QUERIES['replicates'])
+    if kind == 'annotations':
+        from .pca_plot import convert_string_cols
+        df = pd.read_sql(ANNOTATION_QUERY, conn)
+        if len(df.index) == 0:
+            return pd.DataFrame({'replicateId': pd.Series(dtype=np.int64)})
+        return convert_string_cols(df)
+    if kind == 'rts':
+        from .std_peptide_rt_plot import get_precursor_rts
+        return get_precursor_rts(conn, proteins)
+    raise ValueError(f"Unknown dataset '{kind}'")
+
+
+def _log2_frame(matrix):
+    mat, _, cols = matrix
+    return pd.DataFrame(log2_transform(mat), columns=cols)
+
+
+def _render_histogram(plot, inputs, fname, dpi):
+    from .histogram import binned_histogram
+    counts, edges = inputs[0]
+    binned_histogram(counts, edges, plot.get('xlab', plot['column']), ylab=plot.get('ylab', 'Count'),
+                     limits=plot.get('limits'), fname=fname, dpi=dpi)
+
+
+def _render_box_plot(plot, inputs, fname, dpi):
+    from .histogram import box_plot
+    box_plot(_log2_frame(inputs[0]), plot.get('ylab', 'Log2(Area)'), fname=fname, dpi=dpi,
+             hline=plot.get('hline'), limits=plot.get('limits'), max_boxes=plot.get('max_boxes'))
+
+
+def _render_multi_boxplot(plot, inputs, fname, dpi):
+    from .histogram import multi_boxplot
+    dats = {value: _log2_frame(matrix) for value, matrix in zip(plot['values'], inputs)}
+    multi_boxplot(dats, {value: i for i, value in enumerate(plot['values'])},
+                  ylab=plot.get('ylab', 'Log2(Area)'), fname=fname, dpi=dpi,
+                  max_boxes=plot.get('max_boxes'))
+
+
+def _render_bar_chart(plot, inputs, fname, dpi):
+    ''' Number of precursors detected in each replicate by charge. '''
+    from .bar_chart import bar_chart
+    mat, rows, _ = inputs[0]
+    charges = rows.get_level_values('precursorCharge').to_numpy()
+    detected = ~np.isnan(mat)
+    dat = pd.DataFrame({charge: detected[charges == charge].sum(axis=0) for charge in np.unique(charges)},
+                       index=np.arange(mat.shape[1]))
+    bar_chart(dat, plot.get('ylab', 'Number of precursors'), legend_title=plot.get('legend_title', 'Charge'),
+              fname=fname, dpi=dpi, max_bars=plot.get('max_bars'))
+
+
+def _render_pca(plot, inputs, fname, dpi):
+    from .pca_plot import pc_matrix, pca_plot
+    matrix, replicates, annotations = inputs
+    pc, pc_var = pc_matrix(_log2_frame(matrix), n_components=plot.get('n_components'),
+                           svd_solver=plot.get('svd_solver', 'auto'), impute=plot.get('impute', 'half_min'),
+                           max_missing=plot.get('max_missing'))
+    labels = replicates.merge(annotations, on='replicateId', how='left').set_index('replicateId')
+    pc = pc.join(labels)
+    pca_plot(pc, plot.get('color_by', 'acquiredRank'), pc_var,
+             label_type=plot.get('label_type', 'continuous'), fname=fname, dpi=dpi)
+
+
+def _render_rt(plot, inputs, fname, dpi):
+    from .std_peptide_rt_plot import plot_precursor_rts
+    df = inputs[0]
+    df = df[df['protein'] == plot['protein']].drop(columns='protein')
+    if len(df.index) == 0:
+        raise ValueError(f"No precursors found for protein '{plot['protein']}'")
+    plot_precursor_rts(df, plot['protein'], fname=fname, dpi=dpi)
+
+
+_RENDERERS = {'histogram': _render_histogram,
+              'box_plot': _render_box_plot,
+              'multi_boxplot': _render_multi_boxplot,
+              'bar_chart': _render_bar_chart,
+              'pca': _render_pca,
+              'rt': _render_rt}
+
+
+def _init_worker(data):
+    ''' Use the Agg backend and store the shared datasets in worker processes. '''
+    import matplotlib
+    matplotlib.use('Agg')
+    global _REPORT_DATA
+    _REPORT_DATA = data
+
+
+def _render_task(task, dpi):
+    '''
+    Render a task using the datasets in _REPORT_DATA.
+    Returns a tuple of the seconds taken and the error message if the plot failed.
+    '''
+    start = perf_counter()
+    try:
+        inputs = [_REPORT_DATA[key] for key in task['keys']]
+        _RENDERERS[task['plot']['type']](task['plot'], inputs, task['fname'], dpi)
+    except Exception as e:
+        return perf_counter() - start, f'{type(e).__name__}: {e}'
+    return perf_counter() - start, None
+
+
+def run_report(db_path, spec, out_dir, dpi=250, n_workers=None, manifest='manifest.json'):
+    '''
+    Render a QC report from a database.
+
+    The datasets needed by all the plots are planned first so shared data,
+    such as the precursor matrix used by box plots, bar charts and PCA, is
+    only queried once. Figures are then rendered in parallel worker processes
+    with the Agg backend. With the fork start method the workers share the
+    datasets with the parent process instead of copying them.
+
+    Parameters
+    ----------
+    db_path: str
+        Path to the database. It is opened read only.
+    spec: list
+        A list of plot dicts. Each dict has a 'type' in PLOT_TYPES, an optional
+        'name' used for the file name, and options for the plot type:
+        'histogram': 'column', and optionally 'table', 'bins', 'limits', 'xlab'.
+        'box_plot': optionally 'value', 'ylab', 'hline', 'limits', 'max_boxes'.
+        'multi_boxplot': 'values', and optionally 'ylab', 'max_boxes'.
+        'bar_chart': Precursors detected in each replicate by charge. Optionally 'value', 'max_bars'.
+        'pca': optionally 'level' ('precursor' or 'protein'), 'value', 'normalized',
+               'color_by', 'label_type', 'n_components', 'svd_solver', 'impute', 'max_missing'.
+        'rt': 'proteins'. A plot is drawn for each protein.
+        'value' is a precursors column. The default is normalizedArea if the
+        database is normalized, otherwise totalAreaFragment.
+    out_dir: str
+        Directory to write plots and the manifest to.
+    dpi: int
+        250 is the default.
+    n_workers: int
+        Number of worker processes. If None, os.cpu_count() is used.
+        If 1, plots are rendered in the current process.
+    manifest: str
+        Manifest file name in out_dir.
+
+    Returns
+    -------
+    manifest: dict
+        The manifest written to out_dir with the files written for each plot,
+        any plot errors, and the seconds taken by each stage, query and plot.
+        None if the report could not be planned.
+    '''
+    global _REPORT_DATA
+    start = perf_counter()
+    stages = dict()
+
+    conn = connect_read_only(db_path)
+    try:
+        plan = plan_report(conn, spec, out_dir)
+        if plan is None:
+            return None
+        keys, tasks, proteins = plan
+        stages['plan'] = perf_counter() - start
+
+        query_start = perf_counter()
+        queries = list()
+        data = dict()
+        for key in keys:
+            key_start = perf_counter()
+            data[key] = _fetch(conn, key, proteins)
+            queries.append({'dataset': _key_name(key), 'seconds': perf_counter() - key_start})
+            LOGGER.debug(f"Fetched '{_key_name(key)}' in {queries[-1]['seconds']:.2f} seconds.")
+        stages['query'] = perf_counter() - query_start
+    finally:
+        conn.close()
+
+    missing = [_key_name(key) for key, value in data.items() if value is None]
+    if len(missing) > 0:
+        LOGGER.error(f'Failed to fetch datasets: {missing}')
+        return None
+
+    os.makedirs(out_dir, exist_ok=True)
+    render_start = perf_counter()
+    n_workers = os.cpu_count() if n_workers is None else n_workers
+    if n_workers == 1 or len(tasks) <= 1:
+        _REPORT_DATA = data
+        try:
+            results = [_render_task(task, dpi) for task in tasks]
+        finally:
+            _REPORT_DATA = dict()
+    else:
+        with ProcessPoolExecutor(max_workers=min(n_workers, len(tasks)),
+                                 initializer=_init_worker, initargs=(data,)) as executor:
+            futures = [executor.submit(_render_task, task, dpi) for task in tasks]
+            results = [future.result() for future in futures]
+    stages['render'] = perf_counter() - render_start
+
+    plots = list()
+    for task, (seconds, error) in zip(tasks, results):
+        plots.append({'name': task['name'], 'type': task['plot']['type'],
+                      'file': None if error else os.path.basename(task['fname']),
+                      'seconds': seconds, 'error': error})
+        if error:
+            LOGGER.error(f"Failed to render plot '{task['name']}': {error}")
+    stages['total'] = perf_counter() - start
+
+    ret = {'database': os.path.abspath(db_path), 'stages': stages,
+           'queries': queries, 'plots': plots}
+    with open(os.path.join(out_dir, manifest), 'w') as outF:
+        json.dump(ret, outF, indent=2)
+
+    n_failed = sum(plot['error'] is not None for plot in plots)
+    LOGGER.info(f"Rendered {len(plots) - n_failed} of {len(plots)} plots with {len(queries)} queries "
+                f"in {stages['total']:.1f} seconds.")
+    return ret
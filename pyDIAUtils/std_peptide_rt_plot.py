@@ -1,8 +1,53 @@
 
+import os
+from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-from matplotlib.patches import Rectangle, Patch
-from matplotlib.ticker import MaxNLocator
+
+from .logger import LOGGER
+from .profiling import instrument_module
+from .dia_db_utils import PRECURSOR_RT_QUERY, cached_query
+from .plotting import get_pyplot
+
+
+# Maximum number of protein names bound in a single query.
+MAX_QUERY_PROTEINS = 900
+
+
+def get_precursor_rts(conn, protein_ids, use_cache=False, cache_dir=None):
+    '''
+    Get precursor RTs for a list of proteins.
+
+    Parameters
+    ----------
+    conn:
+        Database connection
+    protein_ids: list
+        The protein names to get.
+    use_cache: bool
+        Cache query results with dia_db_utils.cached_query?
+    cache_dir: str
+        (optional) Directory to cache query results on disk. Implies use_cache.
+
+    Returns
+    -------
+    df: pd.DataFrame
+        A DataFrame with the columns protein, acquiredRank, modifiedSequence,
+        precursorCharge, rt, minStartTime, and maxEndTime.
+    '''
+    use_cache = use_cache or cache_dir is not None
+    protein_ids = list(dict.fromkeys(protein_ids))
+    dfs = list()
+    for start in range(0, max(len(protein_ids), 1), MAX_QUERY_PROTEINS):
+        batch = protein_ids[start:start + MAX_QUERY_PROTEINS]
+        query = PRECURSOR_RT_QUERY.format(', '.join(['?'] * len(batch)))
+        if use_cache:
+            dfs.append(cached_query(conn, query, params=batch, cache_dir=cache_dir))
+        else:
+            dfs.append(pd.read_sql(query, conn, params=batch))
+    return pd.concat(dfs, ignore_index=True) if len(dfs) > 1 else dfs[0]
 
 
 def peptide_rt_plot(protein_id, conn, fname=None, dpi=250):
@@ -19,45 +64,125 @@ def peptide_rt_plot(protein_id, conn, fname=None, dpi=250):
         (optional) filename to write plot to.
     '''
 
-    query = '''
-    SELECT
-        r.acquiredRank,
-        p.modifiedSequence,
-        p.precursorCharge,
-        p.rt,
-        p.minStartTime,
-        p.maxEndTime
-    FROM precursors p
-    LEFT JOIN replicates r
-        ON p.replicateId = r.replicateId
-	LEFT JOIN peptideToProtein ptp
-		ON p.modifiedSequence == ptp.modifiedSequence
-	LEFT JOIN proteins prot
-		ON prot.proteinId == ptp.proteinId
-    WHERE prot.name = "%s" AND r.includeRep == TRUE;
-    ''' % protein_id
-
-    df = pd.read_sql(query, conn)
+    df = get_precursor_rts(conn, [protein_id])
+    plot_precursor_rts(df, protein_id, fname=fname, dpi=dpi)
+
+
+def _init_worker():
+    ''' Import pyplot in plotting worker processes the same way as in the main process '''
+    get_pyplot()
+
+
+def _timed_plot(df, protein_id, fname, dpi):
+    start = perf_counter()
+    plot_precursor_rts(df, protein_id, fname=fname, dpi=dpi)
+    return perf_counter() - start
+
+
+def peptide_rt_plots(protein_ids, conn, fname_format='{protein}_rt.png', dpi=250, n_workers=None):
+    '''
+    Make RT distribution plots for a list of proteins.
+
+    The precursors for all the proteins are retrieved with a single query
+    and the plots are rendered in parallel. In both the current process and
+    the worker processes the backend is selected with plotting.get_pyplot.
+
+    Parameters
+    ----------
+    protein_ids: list
+        The protein names to plot.
+    conn:
+        Database connection
+    fname_format: str
+        Format string for plot file names. '{protein}' is replaced with the protein name.
+    dpi: int
+        250 is the default.
+    n_workers: int
+        Number of worker processes. If None, os.cpu_count() is used.
+        If 1, plots are rendered in the current process.
+
+    Returns
+    -------
+    timings: dict
+        A dict mapping protein names to the seconds taken to render the plot.
+        Proteins with no precursors are not plotted.
+    '''
+    start = perf_counter()
+    df = get_precursor_rts(conn, protein_ids)
+    LOGGER.info(f'Retrieved {len(df.index)} precursor RTs for {len(protein_ids)} proteins in {perf_counter() - start:.2f} seconds.')
+
+    groups = {protein: group.drop(columns='protein') for protein, group in df.groupby('protein', sort=False)}
+    for protein_id in protein_ids:
+        if protein_id not in groups:
+            LOGGER.warning(f"No precursors found for protein '{protein_id}'!")
+
+    n_workers = os.cpu_count() if n_workers is None else n_workers
+    timings = dict()
+    if n_workers == 1 or len(groups) <= 1:
+        for protein, group in groups.items():
+            timings[protein] = _timed_plot(group, protein, fname_format.format(protein=protein), dpi)
+    else:
+        with ProcessPoolExecutor(max_workers=min(n_workers, len(groups)),
+                                 initializer=_init_worker) as executor:
+            futures = {protein: executor.submit(_timed_plot, group, protein,
+                                                fname_format.format(protein=protein), dpi)
+                       for protein, group in groups.items()}
+            timings = {protein: future.result() for protein, future in futures.items()}
+
+    return timings
+
+
+def plot_precursor_rts(df, title, fname=None, dpi=250):
+    '''
+    Draw the RT range of each precursor in each replicate.
+
+    Every peak is drawn as a rectangle in a single PolyCollection.
+
+    Parameters
+    ----------
+    df: pd.DataFrame
+        DataFrame with the columns acquiredRank, modifiedSequence, precursorCharge,
+        rt, minStartTime, and maxEndTime.
+    title: str
+        Plot title.
+    fname: str
+        (optional) filename to write plot to.
+    dpi: int
+        250 is the default.
+    '''
+    from matplotlib.patches import Patch
+    from matplotlib.collections import PolyCollection
+    from matplotlib.ticker import MaxNLocator
+    plt = get_pyplot()
 
     # rank peptides by mean RT across replicates
+    df = df.copy()
     df['meanRT'] = df.groupby('modifiedSequence')['rt'].transform('mean')
-    df['peptideLabel'] = df[["modifiedSequence", "precursorCharge"]].apply(lambda x: f'{x[0]}{"+" * x[1]}', axis = 1)
-    ranks = {row['peptideLabel']: row['meanRT'] for _, row in df[['meanRT', 'peptideLabel']].drop_duplicates().iterrows()}
+    df['peptideLabel'] = df['modifiedSequence'] + pd.Series('+', index=df.index).str.repeat(df['precursorCharge'])
+    ranks = df[['peptideLabel', 'meanRT']].drop_duplicates('peptideLabel').sort_values('meanRT', kind='stable')
 
     # generate color scale
     cmap = plt.get_cmap('viridis')
-    pallet = cmap([i/len(ranks) for i in range(len(ranks))])
-    colors = {peptide: color for color, (peptide, rank) in zip(pallet, sorted(ranks.items(), key=lambda x: x[1]))}
-    
+    pallet = cmap(np.arange(len(ranks)) / len(ranks))
+    colors = dict(zip(ranks['peptideLabel'], pallet))
+    color_index = pd.Series(np.arange(len(ranks)), index=ranks['peptideLabel'])
+
     fig = plt.figure(figsize = (8, 4), dpi=dpi)
     ax = fig.add_axes([0.1, 0.15, 0.58, 0.75])
 
+    # x position of each replicate
+    x, rep_ranks = pd.factorize(df['acquiredRank'], sort=True)
+
     line_width = 0.4
-    for i, replicate in enumerate(df['acquiredRank'].drop_duplicates()):
-        for _, row in df[df['acquiredRank'] == replicate].iterrows():
-            ax.add_patch(Rectangle((i - (line_width / 2), row['minStartTime']),
-                                    line_width, row['maxEndTime'] - row['minStartTime'],
-                                    color=colors[row['peptideLabel']]))
+    sele = df[['minStartTime', 'maxEndTime']].notna().all(axis=1).to_numpy()
+    x0 = x[sele] - (line_width / 2)
+    x1 = x0 + line_width
+    y0 = df.loc[sele, 'minStartTime'].to_numpy()
+    y1 = df.loc[sele, 'maxEndTime'].to_numpy()
+    verts = np.stack([np.column_stack([x0, y0]), np.column_stack([x0, y1]),
+                      np.column_stack([x1, y1]), np.column_stack([x1, y0])], axis=1)
+    peak_colors = pallet[df.loc[sele, 'peptideLabel'].map(color_index).to_numpy()]
+    ax.add_collection(PolyCollection(verts, facecolors=peak_colors, edgecolors=peak_colors))
 
     ax.legend(handles = [Patch(color=color, label=label) for label, color in colors.items()],
               bbox_to_anchor=(1.05, 1), loc='upper left', borderaxespad=0.)
@@ -66,17 +191,17 @@ def peptide_rt_plot(protein_id, conn, fname=None, dpi=250):
     ax.set_ylabel('RT (min)')
     ax.xaxis.set_major_locator(MaxNLocator(integer=True))
 
-    min_rt = min(df['minStartTime'])
-    max_rt = max(df['maxEndTime'])
+    min_rt = df['minStartTime'].min()
+    max_rt = df['maxEndTime'].max()
     rt_range = max_rt - min_rt
     y_padding = rt_range * 0.05
 
-    n_reps = len(df['acquiredRank'].drop_duplicates())
+    n_reps = len(rep_ranks)
     x_padding = n_reps * 0.02
 
     plt.xlim([0 - 0.5 - x_padding, n_reps - 0.5 + x_padding])
     plt.ylim([min_rt - y_padding, max_rt + y_padding])
-    plt.title(protein_id)
+    plt.title(title)
 
     if fname:
         plt.savefig(fname)
@@ -84,3 +209,5 @@ def peptide_rt_plot(protein_id, conn, fname=None, dpi=250):
         plt.show()
     plt.close()
 
+
+instrument_module(__name__)
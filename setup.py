@@ -9,7 +9,8 @@ setup(name='pyDIAUtils',
       install_requires=['matplotlib>=0.1.6',
                         'scikit-learn>=1.3.2',
                         'numpy>=1.26.2',
-                        'pandas>=2.1.4']
+                        'pandas>=2.1.4'],
+      extras_require={'parquet': ['pyarrow']}
 
 )
 